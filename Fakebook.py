@@ -1,4 +1,18 @@
-from app import app
+import os
 
+# The password hashing workers (see app/passwords.py) import this module again as they start, so the app is only
+# imported and started when it is being run.
 
-app.run(debug=True)
\ No newline at end of file
+if __name__ == '__main__':
+
+    from app import app, push_hub
+    from app.push import PushServer
+
+    # Start the push server alongside the Flask app, in the same process so that events published while handling
+    # requests reach it. With debug=True the requests are handled by a child process started by the reloader, so only
+    # start it there.
+
+    if app.config['PUSH_SERVER_PORT'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        PushServer(app, push_hub, app.config['PUSH_HEARTBEAT_INTERVAL']).start(app.config['PUSH_SERVER_HOST'], app.config['PUSH_SERVER_PORT'])
+
+    app.run(debug=True)
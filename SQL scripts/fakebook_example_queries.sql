@@ -7,4 +7,9 @@
 -- Get number of likes for a Post based on the Post's id
 select post_id, count(post_id) as 'likes' from PostLike where PostLike.post_id = 2
 
--- Continue writing SQL queries to execute required functionality for other success criteria of FakeBook, using the test data where necessary.
\ No newline at end of file
+-- Continue writing SQL queries to execute required functionality for other success criteria of FakeBook, using the test data where necessary.
+
+-- Search for users and posts using the full-text search indexes (see migration 4 in app/migrations.py), which can use
+-- an index unlike LIKE '%term%'. Quoted words with a trailing * match any word starting with the text typed so far.
+-- select User.id, User.username, User.first_name, User.surname from User join UserSearch on UserSearch.rowid = User.id where UserSearch match '"dim"*' order by UserSearch.rank;
+-- select Post.* from Post join PostSearch on PostSearch.rowid = Post.id where PostSearch match '"first"*' and Post.public = 1 order by PostSearch.rank;
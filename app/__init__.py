@@ -1,30 +1,200 @@
-from flask import Flask, g
+from flask import Flask, g, session, request, has_request_context
 from config import Config
-import sqlite3
+from app.db_pool import ConnectionPool
+from app.replication import ReplicaSet
+from app.write_behind import LastActiveBuffer
+from app.friend_graph import FriendGraphCache
+from app.push import PushHub
+from app.media import MediaStore, process_media_command
+from app.passwords import PasswordHasher, RateLimiter
+from app.profiler import RequestProfile, ProfiledConnection, QueryMetrics, render_toolbar
+from app.cache import Cache, MemoryBackend, SQLiteBackend
+from app.timeline import TimelineFanout, rebuild_timelines_command
+from app.suggestions import recompute_suggestions_command
+import sqlite3, atexit
 
 app = Flask(__name__)
 app.config.from_object(Config)  # Use the Config class within config.py to provide the app's config settings
 
 # Define functions required to get threaded database object
 
-def connect_db():
-    rv = sqlite3.connect(app.config['DATABASE_PATH'])
+def connect_db(path=None):
+    # Connections are shared between request threads by the pool, but only ever used by one thread at a time
+    rv = sqlite3.connect(path or app.config['DATABASE_PATH'], check_same_thread=False,
+                         cached_statements=app.config['DB_STATEMENT_CACHE_SIZE'])
     rv.row_factory = sqlite3.Row
+
+    # WAL mode lets readers carry on while another connection is writing, and with it synchronous=NORMAL only syncs
+    # at checkpoints rather than on every commit
+    rv.execute("PRAGMA journal_mode = {}".format(app.config['DB_JOURNAL_MODE']))
+    rv.execute("PRAGMA synchronous = {}".format(app.config['DB_SYNCHRONOUS']))
+    rv.execute("PRAGMA cache_size = -{:d}".format(app.config['DB_CACHE_SIZE_KB']))
+    rv.execute("PRAGMA mmap_size = {:d}".format(app.config['DB_MMAP_SIZE']))
+    rv.execute("PRAGMA busy_timeout = {:d}".format(app.config['DB_BUSY_TIMEOUT_MS']))
     return rv
 
+db_pool = ConnectionPool(connect_db, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+
+# Read-only queries can be sent to replicas of the database, if any are configured
+replicas = None
+
+if app.config['READ_REPLICA_PATHS']:
+    replicas = ReplicaSet(connect_db, app.config['READ_REPLICA_PATHS'], app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+
+# User last_active timestamps are buffered and written in batches
+last_active_buffer = LastActiveBuffer(db_pool, app.config['LAST_ACTIVE_MAX_PENDING'],
+                                      on_flush=replicas.record_write if replicas is not None else None)
+last_active_buffer.start_flush_thread(app.config['LAST_ACTIVE_FLUSH_INTERVAL'], app.logger)
+atexit.register(last_active_buffer.flush)
+
+# Each User's friends and pending invitations are cached in memory
+friend_graph = FriendGraphCache(app.config['FRIEND_GRAPH_CACHE_SIZE'])
+
+# Uploaded media files, with resized variants generated in the background
+media_store = MediaStore(app.config['UPLOAD_FOLDER'], db_pool, app.config['MEDIA_VARIANTS'], app.config['MEDIA_WORKERS'],
+                         app.logger, on_write=replicas.record_write if replicas is not None else None)
+app.cli.add_command(process_media_command)
+
+# Password hashes are computed by a pool of worker processes, and login attempts are limited for each email address
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+                                 app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_MAX_PENDING'],
+                                 app.config['PASSWORD_HASH_WAIT_TIMEOUT'])
+atexit.register(password_hasher.shutdown)
+login_limiter = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_EMAIL'], app.config['LOGIN_ATTEMPT_WINDOW'])
+
+# Users' rows and other data that rarely changes, dropped by the write paths in fb_objects.py when it does
+if app.config['CACHE_BACKEND'] == 'sqlite':
+    cache = Cache(SQLiteBackend(app.config['CACHE_SQLITE_PATH']), app.config['CACHE_DEFAULT_TTL'])
+else:
+    cache = Cache(MemoryBackend(app.config['CACHE_MAX_ENTRIES']), app.config['CACHE_DEFAULT_TTL'])
+
+# Each User's home feed is precomputed, with new Posts added to it by a background worker
+timelines = TimelineFanout(db_pool, app.config['TIMELINE_MAX_LENGTH'], app.config['TIMELINE_FANOUT_LIMIT'], cache,
+                           app.logger, on_write=replicas.record_write if replicas is not None else None)
+app.cli.add_command(rebuild_timelines_command)
+
+app.cli.add_command(recompute_suggestions_command)
+
+# Events pushed to signed in users by the push server (see push.py)
+push_hub = PushHub(app.config['PUSH_QUEUE_SIZE'])
+
+# Totals of the queries run by every request, served at /metrics
+query_metrics = QueryMetrics()
+
+def get_query_profile():
+    """Returns the RequestProfile of the queries run during the current application context."""
+    if not hasattr(g, 'query_profile'):
+        g.query_profile = RequestProfile()
+    return g.query_profile
+
+def profiled(connection):
+    """Wraps connection so that the queries run with it are recorded, if query profiling is enabled."""
+    if not app.config['QUERY_PROFILING']:
+        return connection
+    return ProfiledConnection(connection, get_query_profile())
+
 def get_db():
-    """Opens a new database connection if there is none yet for the
-    current application context.
+    """Checks out a database connection from the pool if there is none yet for the
+    current application context. This connection is to the primary database, so
+    must be used for all writes.
     """
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-    return g.sqlite_db
+        g.sqlite_db = db_pool.checkout()
+        g.sqlite_db_changes = g.sqlite_db.total_changes  # Used to tell whether this request has written anything
+        g.profiled_db = profiled(g.sqlite_db)
+    return g.profiled_db
+
+def has_written():
+    """Returns True if the database has been changed during the current application context."""
+    return hasattr(g, 'sqlite_db') and g.sqlite_db.total_changes != g.sqlite_db_changes
+
+def get_read_db():
+    """Returns a database connection for queries that only read data. This is a
+    connection to a replica when there are any and they include every write made
+    by the current session, otherwise it is the primary connection from get_db().
+    """
+    if replicas is None or has_written():
+        return get_db()
+
+    if has_request_context() and session.get('db_write_version', 0) > replicas.synced_version:
+        return get_db()  # The replicas do not include this user's latest write yet
+
+    if not hasattr(g, 'replica_db'):
+        g.replica_pool, g.replica_db = replicas.checkout()
+        g.profiled_replica_db = profiled(g.replica_db)
+    return g.profiled_replica_db
+
+def get_identity_map():
+    """Returns the identity map for the current application context. This holds every Fakebook object loaded while
+    handling the current request, keyed by class name and id, so that each is only fetched from the database once.
+    """
+    if not hasattr(g, 'identity_map'):
+        g.identity_map = {}
+    return g.identity_map
+
+@app.after_request
+def record_write(response):
+    """Remembers the version of any write made during the request in the session,
+    so that this user's reads go to the primary until the replicas include it."""
+    if replicas is not None and has_written():
+        session['db_write_version'] = replicas.record_write()
+    return response
+
+@app.after_request
+def report_queries(response):
+    """Reports the queries run during the request in the response headers and the
+    page, if they are enabled, adds them to the totals for /metrics and logs
+    any query that was repeated enough times to suggest an N+1 problem."""
+    if not app.config['QUERY_PROFILING']:
+        return response
+
+    profile = get_query_profile()
+    total = profile.total
+    threshold = app.config['QUERY_PROFILER_N_PLUS_ONE_THRESHOLD']
+    repeated = profile.repeated_queries(threshold)
+
+    if app.config['QUERY_PROFILER_HEADERS']:
+        response.headers['X-Query-Count'] = str(total.count)
+        response.headers['X-Query-Rows'] = str(total.rows)
+        response.headers['X-Query-Time'] = "{:.2f}ms".format(total.seconds * 1000)
+
+    for sql, stats in repeated:
+        app.logger.warning("Possible N+1 query in %s: ran %d times: %s", request.endpoint, stats.count, sql)
+
+    query_metrics.record(request.endpoint or "unknown", profile, [sql for sql, stats in repeated])
+
+    if app.config['QUERY_PROFILER_TOOLBAR'] and response.mimetype == 'text/html' and not response.direct_passthrough:
+        response.set_data(response.get_data(as_text=True).replace("</body>", render_toolbar(profile, threshold) + "</body>"))
+
+    return response
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
+    """Returns the database connections to their pools at the end of the request."""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        db_pool.checkin(g.pop('sqlite_db'))
+    if hasattr(g, 'replica_db'):
+        g.pop('replica_pool').checkin(g.pop('replica_db'))
+
+
+from app import fb_objects, routes, tests, migrations
+
+
+# Bring the database schema up to date before handling any requests, then report any of the hot queries that would
+# have to scan a whole table
+
+with app.app_context():
+
+    if app.config['AUTO_MIGRATE']:
+        for version, description in migrations.migrate(get_db()):
+            app.logger.info("Applied database migration %d: %s", version, description)
+
+    if app.config['CHECK_QUERY_PLANS']:
+        for description, plan_step in migrations.find_unindexed_queries(get_db()):
+            app.logger.warning("Query '%s' is not using an index: %s", description, plan_step)
 
+# Start the replicas from a copy of the migrated database
 
-from app import fb_objects, routes, tests
+if replicas is not None:
+    replicas.sync(app.config['DATABASE_PATH'])
+    replicas.start_sync_thread(app.config['DATABASE_PATH'], app.config['REPLICA_SYNC_INTERVAL'], app.logger)
@@ -0,0 +1,163 @@
+"""
+cache.py
+
+A cache for data that is read far more often than it changes, such as Users' profiles and rendered fragments of pages.
+Entries expire after a time to live. They are also dropped as soon as the data they were made from changes: the write
+paths in fb_objects.py notify the cache of events such as 'user_changed', and handlers registered for each event
+delete the affected keys or bump the versions that other keys include.
+
+Entries are kept in memory in each process by default (MemoryBackend). Set Config.CACHE_BACKEND to 'sqlite' to share
+them, and their invalidation, between every process on the machine through a separate SQLite file (SQLiteBackend).
+Values must be serializable as JSON.
+"""
+from collections import defaultdict, OrderedDict
+import json, sqlite3, threading, time, uuid
+
+
+class MemoryBackend:
+    """Least recently used entries in this process, up to max_entries"""
+
+    def __init__(self, max_entries):
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()  # key: (expiry time, value)
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.__lock:
+            self.__entries[key] = (time.time() + ttl, value)
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+class SQLiteBackend:
+    """Entries in a SQLite file, shared by every process that uses the same path"""
+
+    # Expired entries are deleted once every this many sets
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.__path = path
+        self.__local = threading.local()  # Each thread has its own connection
+        self.__sets = 0
+
+        db = self.__connection()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS Cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL) WITHOUT ROWID")
+
+    def __connection(self):
+        if not hasattr(self.__local, 'db'):
+            self.__local.db = sqlite3.connect(self.__path, timeout=5)
+            self.__local.db.execute("PRAGMA journal_mode = WAL")
+            self.__local.db.execute("PRAGMA synchronous = OFF")  # Losing the cache in a crash does no harm
+        return self.__local.db
+
+    def get(self, key):
+        row = self.__connection().execute("SELECT value FROM Cache WHERE key = ? AND expires > ?", [key, time.time()]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        db = self.__connection()
+        with db:
+            db.execute("INSERT OR REPLACE INTO Cache (key, value, expires) VALUES (?, ?, ?)", [key, json.dumps(value), time.time() + ttl])
+
+            self.__sets += 1
+            if self.__sets % self.PURGE_INTERVAL == 0:
+                db.execute("DELETE FROM Cache WHERE expires <= ?", [time.time()])
+
+    def delete(self, keys):
+        db = self.__connection()
+        with db:
+            db.executemany("DELETE FROM Cache WHERE key = ?", [(key,) for key in keys])
+
+    def clear(self):
+        db = self.__connection()
+        with db:
+            db.execute("DELETE FROM Cache")
+
+
+class Cache:
+
+    # Versions live much longer than the entries that include them
+    VERSION_TTL = 30 * 24 * 60 * 60
+
+    def __init__(self, backend, default_ttl):
+        """
+        :param backend: a MemoryBackend or SQLiteBackend to store entries in
+        :param default_ttl: the number of seconds entries are kept for, unless given when they are set
+        """
+        self.__backend = backend
+        self.__default_ttl = default_ttl
+        self.__handlers = defaultdict(list)  # event: list of functions
+
+    def get(self, key):
+        """:return: the value cached for key, or None"""
+        return self.__backend.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.__backend.set(key, value, ttl or self.__default_ttl)
+
+    def delete(self, *keys):
+        self.__backend.delete(keys)
+
+    def get_or_set(self, key, make_value, ttl=None):
+        """
+        :param make_value: a function that returns the value for key, called if it is not cached
+        :return: the cached value for key, or the value returned by make_value, which is cached
+        """
+        value = self.get(key)
+        if value is None:
+            value = make_value()
+            self.set(key, value, ttl)
+        return value
+
+    def version(self, name):
+        """:return: the current version of name, which changes each time bump(name) is called"""
+        version = self.__backend.get("version:" + name)
+        if version is None:
+            # A version that has never been used before, so that no entry made before the version was evicted or
+            # expired can be mistaken for a current one
+            version = uuid.uuid4().hex
+            self.__backend.set("version:" + name, version, self.VERSION_TTL)
+        return version
+
+    def bump(self, *names):
+        """Changes the version of each of names, so that every key made with versioned(..., name) is no longer used"""
+        for name in names:
+            self.__backend.set("version:" + name, uuid.uuid4().hex, self.VERSION_TTL)
+
+    def versioned(self, key, *names):
+        """:return: key with the current versions of names added, for an entry made from the data that names describe"""
+        return key + "".join("|{}@{}".format(name, self.version(name)) for name in names)
+
+    def on(self, event, handler):
+        """Registers handler to be called with the arguments given to notify whenever event happens"""
+        self.__handlers[event].append(handler)
+
+    def notify(self, event, *args):
+        """Tells the cache that event has happened, e.g. notify('user_changed', user_id)"""
+        for handler in self.__handlers[event]:
+            handler(*args)
+
+    def clear(self):
+        self.__backend.clear()
@@ -0,0 +1,128 @@
+"""
+db_pool.py
+
+A thread-safe pool of SQLite connections, so that each request reuses an open connection (along with its page cache,
+memory map and prepared statement cache) instead of opening a new one.
+"""
+import queue
+import threading
+import time
+
+
+class ConnectionPoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, max_size, timeout):
+        """
+        :param connect: a function that opens and configures a new connection
+        :param max_size: the maximum number of connections that can be open at once
+        :param timeout: the number of seconds to wait for a connection when all of them are in use
+        """
+        self.__connect = connect
+        self.__max_size = max_size
+        self.__timeout = timeout
+
+        # Idle connections are reused last-in first-out, so that the most recently used (and warmest) one is used next
+        self.__idle = queue.LifoQueue()
+        self.__lock = threading.Lock()
+
+        self.__size = 0
+        self.__in_use = 0
+        self.__checkouts = 0
+        self.__total_wait = 0.0
+        self.__max_wait = 0.0
+
+    def checkout(self):
+        """
+        :return: an idle connection from the pool, opening a new one if there are none and the pool is not full,
+        otherwise waiting for one to be checked in
+        """
+
+        start = time.monotonic()
+
+        try:
+            connection = self.__idle.get_nowait()
+
+        except queue.Empty:
+
+            with self.__lock:
+                can_open = self.__size < self.__max_size
+                if can_open:
+                    self.__size += 1
+
+            if can_open:
+                try:
+                    connection = self.__connect()
+                except Exception:
+                    with self.__lock:
+                        self.__size -= 1
+                    raise
+
+            else:
+                try:
+                    connection = self.__idle.get(timeout=self.__timeout)
+                except queue.Empty:
+                    raise ConnectionPoolExhausted("No database connection became free within {} seconds".format(self.__timeout))
+
+        wait = time.monotonic() - start
+
+        with self.__lock:
+            self.__in_use += 1
+            self.__checkouts += 1
+            self.__total_wait += wait
+            self.__max_wait = max(self.__max_wait, wait)
+
+        return connection
+
+    def checkin(self, connection):
+        """Returns a connection to the pool, rolling back anything that was not committed"""
+
+        with self.__lock:
+            self.__in_use -= 1
+
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+
+        except Exception:
+
+            # The connection is no longer usable, so close it and let a new one be opened in its place
+
+            with self.__lock:
+                self.__size -= 1
+            connection.close()
+            return
+
+        self.__idle.put(connection)
+
+    def close_all(self):
+        """Closes all of the idle connections in the pool"""
+
+        while True:
+            try:
+                connection = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+
+            connection.close()
+
+            with self.__lock:
+                self.__size -= 1
+
+    def metrics(self):
+        """
+        :return: a dictionary of statistics about the use of the pool
+        """
+        with self.__lock:
+            return {
+                'size': self.__size,
+                'max_size': self.__max_size,
+                'in_use': self.__in_use,
+                'idle': self.__size - self.__in_use,
+                'checkouts': self.__checkouts,
+                'total_wait_seconds': self.__total_wait,
+                'max_wait_seconds': self.__max_wait,
+            }
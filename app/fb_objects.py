@@ -1,11 +1,326 @@
-from app import get_db  # required so that the Fakebook objects that map database relations can access the database
+from app import get_db, get_read_db, get_identity_map, last_active_buffer, friend_graph, push_hub, password_hasher, login_limiter, cache, timelines  # required so that the Fakebook objects that map database relations can access the database
 from abc import ABC
-from werkzeug.security import generate_password_hash, check_password_hash
+from collections import namedtuple
+from app.friend_graph import FriendEdge
+from app import suggestions
 from datetime import datetime
+import base64, json, re
+
+
+# The number of posts shown on each page of a feed
+FEED_PAGE_SIZE = 20
+
+# The maximum number of chat messages returned by each fetch
+MESSAGE_PAGE_SIZE = 50
+
+# The number of seconds a User's row is cached for. The cached copy is dropped whenever the User is changed through
+# fb_objects.py, but last_active is also written by the write-behind buffer, so it can be this far out of date.
+USER_CACHE_TTL = 60
+
+# SQLite limits the number of parameters in a single statement, so IN (...) lookups are split into chunks of this size
+IN_QUERY_CHUNK_SIZE = 500
+
+
+def unique_ids(ids):
+    """
+    :param ids: an iterable of ids, as ints or strings
+    :return: a list of the distinct ids as ints, in the order they were first seen
+    """
+    seen = []
+    for id in ids:
+        if id is not None and id != '' and int(id) not in seen:
+            seen.append(int(id))
+    return seen
+
+
+def chunks(ids):
+    for i in range(0, len(ids), IN_QUERY_CHUNK_SIZE):
+        yield ids[i:i + IN_QUERY_CHUNK_SIZE]
+
+
+def placeholders(ids):
+    return ",".join("?" * len(ids))
+
+
+def full_text_query(search_text):
+    """
+    :param search_text: text entered by a user to search for
+    :return: an FTS5 MATCH query that finds rows containing every word of search_text, where the last word may be
+    incomplete (so results appear while a user is still typing), or None if search_text contains no words
+    """
+    words = re.findall(r"\w+", search_text)
+
+    if not words:
+        return None
+
+    # Quoting each word stops it being treated as FTS5 syntax (e.g. AND, NEAR or a column name)
+    return " ".join('"{}"'.format(word) for word in words) + "*"
+
+
+class InvalidCursorException(Exception):
+    pass
+
+
+class Page(list):
+    """
+    A list of the objects on one page of a paginated query. next_cursor holds the sort key of the last object on the
+    page, to be passed as after= to fetch the next page, or None if this is the last page.
+    """
+
+    def __init__(self, objects, next_cursor=None):
+        super().__init__(objects)
+        self.next_cursor = next_cursor
+
+    @property
+    def next_token(self):
+        """An opaque token for next_cursor that can be included in URLs and decoded again with decode_cursor"""
+        if self.next_cursor is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(self.next_cursor).encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    :param token: a token returned by Page.next_token, or None
+    :return: the cursor tuple encoded in token, or None if token is None
+    """
+    if token is None:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursorException("Invalid page cursor: {}".format(token))
+
+    # Tokens come from URLs, so anything other than a list of sort key values is rejected before it reaches a query
+    # (None is allowed, as it is the value of a NULL column)
+    if not isinstance(cursor, list) or not cursor or not all(
+            value is None or isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in cursor):
+        raise InvalidCursorException("Invalid page cursor: {}".format(token))
+
+    return tuple(cursor)
+
+
+def after_cursor_conditions(sort_columns, after, descending):
+    """
+    :return: a list of (condition, parameters) for the rows that come after the cursor after, in the order the rows are
+    read. SQLite sorts NULL below every other value, and a comparison with NULL is never true, so the rows whose first
+    sort column is NULL are read separately: after the others when descending, and before them when ascending.
+    """
+
+    names = ['after_{}'.format(i) for i in range(len(sort_columns))]
+    parameters = dict(zip(names, after))
+    operator = "<" if descending else ">"
+
+    def compare(columns, names):
+        return "({}) {} ({})".format(", ".join(columns), operator, ", ".join(":" + name for name in names))
+
+    # The last sort column is the unique key, which is never NULL
+    if len(sort_columns) == 1:
+        return [(compare(sort_columns, names), parameters)]
+
+    first, rest, rest_names = sort_columns[0], sort_columns[1:], names[1:]
+    null_rows = ("{} IS NULL AND {}".format(first, compare(rest, rest_names)), parameters)
+
+    if after[0] is None:
+        return [null_rows] if descending else [null_rows, ("{} IS NOT NULL".format(first), {})]
+
+    not_null_rows = (compare(sort_columns, names), parameters)
+
+    return [not_null_rows, ("{} IS NULL".format(first), {})] if descending else [not_null_rows]
+
+
+def select_page(sql, parameters, sort_columns, after=None, limit=None, descending=True):
+    """
+    Runs a SELECT using keyset pagination, so that every page costs the same however far through the results it is.
+
+    :param sql: a SELECT statement with a WHERE clause but no ORDER BY, using named parameters
+    :param parameters: a dictionary of the named parameters used in sql
+    :param sort_columns: the columns that the results are ordered by, which together must be unique (e.g. ending in id).
+    Only the first of them may be NULL.
+    :param after: the values of sort_columns for the last row of the previous page, or None for the first page
+    :param limit: the maximum number of rows to return, or None for all of them
+    :param descending: True to order by sort_columns from highest to lowest
+    :return: a tuple of the list of rows and the cursor for the next page (None if there are no more rows)
+    """
+
+    if after is None:
+        conditions = [(None, {})]
+    elif len(after) != len(sort_columns):
+        raise InvalidCursorException("Page cursor {} does not match the sort columns {}".format(after, sort_columns))
+    else:
+        conditions = after_cursor_conditions(sort_columns, after, descending)
+
+    order_by = " ORDER BY " + ", ".join(column + (" DESC" if descending else "") for column in sort_columns)
+
+    rows = []
+
+    for condition, condition_parameters in conditions:
+
+        # Fetch one more row than is needed to find out whether there is another page
+        statement_parameters = dict(parameters, **condition_parameters)
+        statement_parameters['page_limit'] = limit + 1 - len(rows) if limit else -1
+
+        rows += get_read_db().execute(sql + (" AND " + condition if condition else "") + order_by + " LIMIT :page_limit",
+                                      statement_parameters).fetchall()
+
+        if limit and len(rows) > limit:
+            break
+
+    next_cursor = None
+
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = tuple(rows[-1][column.split('.')[-1]] for column in sort_columns)
+
+    return rows, next_cursor
+
+
+class lazy_relationship:
+    """
+    Descriptor for a relationship (e.g. the Users who like a Post) that is only loaded from the database the first
+    time it is accessed. The decorated function is given every object that was loaded in the same batch as the one
+    being accessed and returns a list of values in the same order, so that the relationship is loaded for the whole
+    batch with one query rather than one query per object.
+    """
+
+    def __init__(self, batch_loader):
+        self.batch_loader = batch_loader
+        self.attribute_name = '_lazy_' + batch_loader.__name__
+        self.__doc__ = batch_loader.__doc__
+
+    def __get__(self, instance, owner):
+
+        if instance is None:
+            return self
+
+        if not self.is_loaded(instance):
+
+            batch = [obj for obj in instance.batch if not self.is_loaded(obj)]
+            if instance not in batch:
+                batch.append(instance)
+
+            for obj, value in zip(batch, self.batch_loader(batch)):
+                self.prime(obj, value)
+
+        return getattr(instance, self.attribute_name)
+
+    def is_loaded(self, instance):
+        return hasattr(instance, self.attribute_name)
+
+    def prime(self, instance, value):
+        """Sets the value of the relationship for instance without querying the database"""
+        setattr(instance, self.attribute_name, value)
 
 
 class FBObject(ABC):
 
+    # Subclasses list their own fields in __slots__ too, including a '_lazy_' + name slot for each lazy_relationship,
+    # so that the many objects loaded for a page do not each carry an instance dictionary
+    __slots__ = ('loaded', 'batch')
+
+    # SELECT statement (without a WHERE clause) that returns the row(s) used to populate instances of each subclass
+    select_sql = None
+
+    # SELECT statement (without a WHERE clause) that returns the fields of get_dictionary(), named as its keys
+    dictionary_sql = None
+
+    def __new__(cls, id, *args, **kwargs):
+
+        # If an object of this class with this id has already been loaded while handling the current request, return
+        # that instance rather than creating a new one. __init__ checks loaded so that the database is not queried again.
+
+        instance = get_identity_map().get(cls.identity_key(id))
+
+        if instance is None:
+            instance = super().__new__(cls)
+            instance.loaded = False
+            instance.batch = [instance]  # The objects loaded together with this one, used by lazy relationships
+
+        return instance
+
+    @classmethod
+    def identity_key(cls, id):
+        try:
+            return cls.__name__, int(id)
+        except (TypeError, ValueError):
+            return None
+
+    def remember(self):
+        """Adds this object to the identity map for the current request"""
+        self.loaded = True
+        get_identity_map()[self.identity_key(self.id)] = self
+
+    def forget(self):
+        """Removes this object from the identity map for the current request, e.g. once it is deleted"""
+        get_identity_map().pop(self.identity_key(self.id), None)
+
+    @classmethod
+    def load_many(cls, ids):
+        """
+        :param ids: an iterable of ids of objects of this class
+        :return: a list of objects for the ids that exist, in the order given. Objects that have not already been loaded
+        during this request are fetched with one IN (...) query per chunk of ids, along with their related objects.
+        """
+        ids = unique_ids(ids)
+        identity_map = get_identity_map()
+        missing_ids = [id for id in ids if cls.identity_key(id) not in identity_map]
+
+        for chunk in chunks(missing_ids):
+            rows = get_read_db().execute("{} WHERE {}.id IN ({})".format(cls.select_sql, cls.__name__, placeholders(chunk)),
+                                    chunk).fetchall()
+            cls.from_rows(rows)
+
+        return [identity_map[cls.identity_key(id)] for id in ids if cls.identity_key(id) in identity_map]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: rows selected using select_sql
+        :return: a list of objects for the rows, in row order, reusing any that have already been loaded during this
+        request. Newly created objects share a batch, so their lazy relationships are loaded together.
+        """
+        identity_map = get_identity_map()
+        objects = []
+        new_objects = []
+
+        for row in rows:
+            obj = identity_map.get(cls.identity_key(row['id']))
+            if obj is None:
+                obj = cls(row['id'], row)
+                obj.batch = new_objects
+                new_objects.append(obj)
+            objects.append(obj)
+
+        return objects
+
+    @classmethod
+    def get_dictionaries(cls, ids, condition=None, parameters=None):
+        """
+        :param ids: an iterable of ids of objects of this class
+        :param condition: an optional SQL condition that rows must also meet, using named parameters
+        :param parameters: a dictionary of the values of the parameters in condition
+        :return: a list of the dictionaries that get_dictionary() would return for the ids that exist (and meet
+        condition), in the order given. They are made straight from rows selected with dictionary_sql, without creating
+        any objects, so serializing a large batch costs one query per chunk of ids.
+        """
+        ids = unique_ids(ids)
+        dictionaries = {}
+
+        for chunk in chunks(ids):
+            id_parameters = {"id{}".format(i): id for i, id in enumerate(chunk)}
+            sql = "{} WHERE {}.id IN ({})".format(cls.dictionary_sql, cls.__name__, ",".join(":" + name for name in id_parameters))
+            if condition:
+                sql += " AND " + condition
+            for row in get_read_db().execute(sql, dict(parameters or {}, **id_parameters)):
+                dictionaries[row['id']] = cls.row_dictionary(row)
+
+        return [dictionaries[id] for id in ids if id in dictionaries]
+
+    @staticmethod
+    def row_dictionary(row):
+        """:return: the dictionary for a row selected with dictionary_sql, whose columns are named as in get_dictionary()"""
+        return dict(row)
+
     def get_dictionary(self):
         pass
 
@@ -27,14 +342,41 @@ class UsernameAlreadyInUseException(Exception):
 class EmailAlreadyInUseException(Exception):
     pass
 
+class TooManyLoginAttemptsException(Exception):
+    pass
+
 
 class User(FBObject):
 
-    def __init__(self, id):
+    __slots__ = ('__id', '__username', '__email', '__first_name', '__surname', '__joined', '__profile_pic_id',
+                 '__profile_pic_path', '__bio', '__dob', '__last_active', '_lazy_profile_pic_variants')
 
-        db = get_db()
+    select_sql = "SELECT User.id, User.username, User.email, User.first_name, User.surname, User.joined, User.bio, " \
+                 "User.dob, Media.file_path, User.last_active, User.profile_pic_id " \
+                 "FROM User LEFT JOIN Media ON User.profile_pic_id = Media.id"
+
+    dictionary_sql = "SELECT User.id, User.username, User.first_name, User.surname, User.joined, " \
+                     "Media.file_path AS profile_pic_path, User.bio, User.dob " \
+                     "FROM User LEFT JOIN Media ON User.profile_pic_id = Media.id"
+
+    # The Users with the most friends in common with the User with id :user_id, excluding anyone they already have a
+    # Friendship (accepted or not) with
+    suggestions_sql = "SELECT candidate_id, mutual_count FROM FriendSuggestion WHERE user_id = :user_id AND NOT EXISTS (" \
+                      "SELECT 1 FROM Friendship WHERE min(initiator_id, recipient_id) = min(:user_id, candidate_id) " \
+                      "AND max(initiator_id, recipient_id) = max(:user_id, candidate_id)) " \
+                      "ORDER BY mutual_count DESC LIMIT :limit"
+
+    # Users whose username, first name or surname match the full-text query :query, best matches first
+    search_sql = select_sql + " JOIN UserSearch ON UserSearch.rowid = User.id WHERE UserSearch MATCH :query " \
+                              "ORDER BY UserSearch.rank LIMIT :limit"
 
-        user_data = db.execute("SELECT User.username, User.email, User.first_name, User.surname, User.joined, User.bio, User.dob, Media.file_path, User.last_active, User.profile_pic_id, Media.id FROM User, Media WHERE User.profile_pic_id = Media.id and User.id=?", [id]).fetchone()
+    def __init__(self, id, user_data=None):
+
+        if self.loaded:
+            return  # Already loaded during this request
+
+        if user_data is None:
+            user_data = User.load_row(id)
 
         if user_data:
             self.__id = int(id)
@@ -43,14 +385,44 @@ class User(FBObject):
             self.__first_name = user_data['first_name']
             self.__surname = user_data['surname']
             self.__joined = user_data['joined']
+            self.__profile_pic_id = user_data['profile_pic_id']
             self.__profile_pic_path = user_data['file_path']
             self.__bio = user_data['bio']
             self.__dob = user_data['dob']
             self.__last_active = user_data['last_active']
 
+            self.remember()
+
         else:
             raise UserIDNotFoundException
 
+    @staticmethod
+    def load_row(id):
+        """
+        :return: a dictionary of the columns of select_sql for the User with id, from the cache if it is there, or None
+        if there is no such User
+        """
+
+        row = cache.get(User.cache_key(id))
+
+        if row is None:
+            row = get_read_db().execute(User.select_sql + " WHERE User.id=?", [id]).fetchone()
+            if row:
+                row = dict(row)
+                cache.set(User.cache_key(id), row, USER_CACHE_TTL)
+
+        return row
+
+    @staticmethod
+    def cache_key(id):
+        """:return: the key the User's row is cached with, which is also the version name for data made from it"""
+        return "user:{:d}".format(int(id))
+
+    @staticmethod
+    def friends_version_name(id):
+        """:return: the version name for cached data made from the Friendships of the User and of their friends"""
+        return "friends:{:d}".format(int(id))
+
     @property
     def id(self):
         return self.__id
@@ -75,6 +447,30 @@ class User(FBObject):
     def profile_pic_path(self):
         return self.__profile_pic_path
 
+    @lazy_relationship
+    def profile_pic_variants(users):
+        """A dictionary of variant name: file path for the resized copies of each User's profile picture"""
+
+        media_ids = unique_ids(user.__profile_pic_id for user in users)
+        variants = {media_id: {} for media_id in media_ids}
+
+        for chunk in chunks(media_ids):
+            for row in get_read_db().execute("SELECT media_id, variant, file_path FROM MediaVariant WHERE media_id IN ({})"
+                                             .format(placeholders(chunk)), chunk):
+                variants[row['media_id']][row['variant']] = row['file_path']
+
+        return [variants.get(user.__profile_pic_id, {}) for user in users]
+
+    def get_profile_pic_path(self, variant=None):
+        """
+        :param variant: the name of one of Config.MEDIA_VARIANTS, or None for the original
+        :return: the path of the variant of this User's profile picture, or of the original if that variant has not
+        been made (because it is still being made, the original is already small enough, or Pillow is not installed)
+        """
+        if variant is None or self.__profile_pic_id is None:
+            return self.__profile_pic_path
+        return self.profile_pic_variants.get(variant, self.__profile_pic_path)
+
     @property
     def bio(self):
         return self.__bio
@@ -85,6 +481,10 @@ class User(FBObject):
 
     @property
     def last_active(self):
+        # A more recent timestamp may be waiting in the buffer to be written to the database
+        pending = last_active_buffer.pending(self.id)
+        if pending and (self.__last_active is None or pending > self.__last_active):
+            return pending
         return self.__last_active
 
     @property
@@ -99,21 +499,56 @@ class User(FBObject):
     def public_posts(self):
         return self.get_public_posts()
 
+    @staticmethod
+    def search(search_text, limit=20):
+        """
+        :param search_text: the text to search for in usernames, first names and surnames
+        :param limit: the maximum number of Users to return
+        :return: a list of matching Users, best matches first
+        """
+
+        query = full_text_query(search_text)
+
+        if query is None:
+            return []
+
+        return User.from_rows(get_read_db().execute(User.search_sql, {'query': query, 'limit': limit}).fetchall())
+
     @staticmethod
     def login_user(email, password):
 
+        # Limit the number of attempts for each email address, so that guessing passwords is slow and cannot keep the
+        # password hashing workers busy
+
+        if not login_limiter.attempt(email.lower()):
+            raise TooManyLoginAttemptsException
+
         # look for user instance in User table with matching email. If found, check their password_hash
 
-        user_row = get_db().execute("SELECT id, email, password_hash FROM User WHERE email=?",[email]).fetchone()
+        user_row = get_read_db().execute("SELECT id, email, password_hash FROM User WHERE email=?",[email]).fetchone()
+
+        if user_row and password_hasher.check(user_row['password_hash'], password):
+
+            login_limiter.reset(email.lower())
+
+            # The password is known now, so a hash made with out of date settings can be replaced
+
+            if password_hasher.needs_rehash(user_row['password_hash']):
+                db = get_db()
+                db.execute("UPDATE User SET password_hash=? WHERE id=?", [password_hasher.generate(password), user_row['id']])
+                db.commit()
 
-        if user_row and check_password_hash(user_row['password_hash'], password):
             return User(user_row['id'])
 
         else:
             raise UserLoginFailedException
 
     @staticmethod
-    def register_user(username, email, password, first_name, surname, profile_pic_path, bio, dob):
+    def register_user(username, email, password, first_name, surname, profile_pic_id, bio, dob):
+        """
+        :param profile_pic_id: the id of the Media for the User's profile picture, saved by MediaStore.save_upload, or
+        None
+        """
 
         db = get_db()
         cur = db.cursor()
@@ -131,25 +566,18 @@ class User(FBObject):
             raise EmailAlreadyInUseException
 
 
-        # Add Media entry for profile pic first
-
-        media_id = None
-
-        if profile_pic_path != "":
-
-            cur.execute("INSERT INTO Media VALUES (NULL, ?)", [profile_pic_path])
-            media_id = cur.lastrowid
-
-        # Now add entry to User table
+        # Add entry to User table
 
         joined = datetime.utcnow()
 
-        cur.execute("INSERT INTO User VALUES (NULL, ?,?,?,?,?,?,?,?,?,?)", [username, email, generate_password_hash(password), first_name, surname, joined, media_id, bio, dob, str(datetime.utcnow())])
+        cur.execute("INSERT INTO User VALUES (NULL, ?,?,?,?,?,?,?,?,?,?)", [username, email, password_hasher.generate(password), first_name, surname, joined, profile_pic_id, bio, dob, str(datetime.utcnow())])
 
         user_id = cur.lastrowid
 
         db.commit()
 
+        cache.notify('user_changed', user_id)
+
         return User(user_id)
 
     def __repr__(self):
@@ -172,9 +600,11 @@ class User(FBObject):
         if not date:
             date = str(datetime.utcnow())
 
-        db = get_db()
-        db.execute("UPDATE User SET last_active=? WHERE id=?", [date, self.id])
-        db.commit()
+        # The timestamp is written to the database in a batch with other Users' by the write-behind buffer
+        last_active_buffer.record(self.id, date)
+
+        self.__last_active = date
+        cache.notify('user_changed', self.id)
 
     def get_posts(self):
 
@@ -196,6 +626,10 @@ class User(FBObject):
 
         return Post.get_user_posts(self, viewer)
 
+    def get_feed(self, after=None):
+
+        return Post.get_home_feed(self, after=after)  # Posts by this User and their friends, newest first
+
     def initiate_friendship(self, recipient):
 
         return Friendship.initiate_friendship(self, recipient)
@@ -208,29 +642,52 @@ class User(FBObject):
 
         return f
 
+    def get_friend_graph(self):
+
+        # Returns the cached UserAdjacency holding the ids of this User's friends and pending invitations
+
+        return Friendship.get_adjacency(self.id)
+
+    def get_mutual_friends(self, other_user):
+
+        # Returns a list of the Users that are friends with both this User and other_user
+
+        mutual_ids = self.get_friend_graph().friends & other_user.get_friend_graph().friends
+
+        return User.load_many(sorted(mutual_ids))
+
+    def get_friend_suggestions(self, limit=10):
+        """
+        :param limit: the maximum number of suggestions to return
+        :return: a list of (User, number of mutual friends) for the Users this User is most likely to know, best first
+        """
+
+        # Cached until a Friendship of this User or of one of their friends changes
+
+        key = cache.versioned("suggestions:{:d}:{:d}".format(self.id, limit), User.friends_version_name(self.id))
+
+        rows = cache.get_or_set(key, lambda: [[row['candidate_id'], row['mutual_count']] for row in get_read_db().execute(
+            User.suggestions_sql, {'user_id': self.id, 'limit': limit})])
+
+        User.load_many([candidate_id for candidate_id, mutual_count in rows])
+
+        return [(User(candidate_id), mutual_count) for candidate_id, mutual_count in rows]
+
     def get_friendship_invitations(self):
 
         # Returns a list of friendships that the user is the recipient of and has not yet accepted.
 
-        waiting_friendships = []
+        graph = self.get_friend_graph()
 
-        for f in self.get_friendships():
-            if not f.accepted and f.recipient.id == self.id:
-                waiting_friendships.append(f)
-
-        return waiting_friendships
+        return Friendship.from_edges([graph.edges[user_id] for user_id in graph.pending_in])
 
     def get_waiting_friendship_invitations(self):
 
         # Returns a list of friendships that the user has initiated but have not been accepted yet.
 
-        waiting_friendships = []
-
-        for f in self.get_friendships():
-            if not f.accepted and f.initiator.id == self.id:
-                waiting_friendships.append(f)
+        graph = self.get_friend_graph()
 
-        return waiting_friendships
+        return Friendship.from_edges([graph.edges[user_id] for user_id in graph.pending_out])
 
 
 """
@@ -244,22 +701,62 @@ class FriendshipDoesNotExist(Exception):
 
 class Friendship(FBObject):
 
-    def __init__(self, id):
+    __slots__ = ('__id', '__initiator_id', '__recipient_id', '__accepted', '__established_date', '_lazy_initiator',
+                 '_lazy_recipient')
+
+    select_sql = "SELECT * FROM Friendship"
+
+    dictionary_sql = "SELECT id, initiator_id, recipient_id, accepted, established_date FROM Friendship"
+
+    # Condition matching the Friendship between the Users with ids :a and :b, whichever of them initiated it, written
+    # so that it can use the Friendship_pair index
+    pair_sql = "min(initiator_id, recipient_id) = min(:a, :b) AND max(initiator_id, recipient_id) = max(:a, :b)"
+
+    def __init__(self, id, friendship_data=None):
+
+        if self.loaded:
+            return  # Already loaded during this request
+
+        if friendship_data is None:
+            friendship_data = get_read_db().execute(Friendship.select_sql + " WHERE id=?", [id]).fetchone()
+
+        if not friendship_data:
+            raise FriendshipDoesNotExist("No Friendship exists with id {}".format(id))
 
-        friendship_data = get_db().execute("SELECT * FROM Friendship WHERE id=?", [id]).fetchone()
         self.__id = int(id)
-        self.__initator = User(friendship_data['initiator_id'])
-        self.__recipient = User(friendship_data['recipient_id'])
+        self.__initiator_id = friendship_data['initiator_id']
+        self.__recipient_id = friendship_data['recipient_id']
         self.__accepted = True if friendship_data['accepted'] == 1 else False
         self.__established_date = friendship_data['established_date']
 
+        self.remember()
+
+    @staticmethod
+    def load_users(friendships):
+        # Loads the initiators and recipients of all of the friendships with a single query
+        User.load_many([f.initiator_id for f in friendships] + [f.recipient_id for f in friendships])
+
+    @lazy_relationship
+    def initiator(friendships):
+        Friendship.load_users(friendships)
+        return [User(f.initiator_id) for f in friendships]
+
+    @lazy_relationship
+    def recipient(friendships):
+        Friendship.load_users(friendships)
+        return [User(f.recipient_id) for f in friendships]
+
     @property
-    def initiator(self):
-        return self.__initator
+    def id(self):
+        return self.__id
 
     @property
-    def recipient(self):
-        return self.__recipient
+    def initiator_id(self):
+        return self.__initiator_id
+
+    @property
+    def recipient_id(self):
+        return self.__recipient_id
 
     @property
     def accepted(self):
@@ -272,37 +769,65 @@ class Friendship(FBObject):
     @staticmethod
     def verify_friendship(a: User, b: User):
 
-        friendship_data = get_db().execute("SELECT * FROM Friendship WHERE accepted = 1 AND ((initiator_id=? and recipient_id=?) or (initiator_id=? AND recipient_id=?))", [a.id, b.id, b.id, a.id]).fetchone()
+        return b.id in Friendship.get_adjacency(a.id).friends
 
-        if friendship_data:
-            return True
-        else:
-            return False
+    @staticmethod
+    def get_adjacency(user_id):
+        """
+        :return: the UserAdjacency for the User with user_id from the friend graph cache, loading it if necessary
+        """
+
+        def load_edges(user_id):
+            # Always read from the primary database, as a replica could be behind and would then stay cached
+            rows = get_db().execute("SELECT id, initiator_id, recipient_id, accepted, established_date FROM Friendship "
+                                    "WHERE initiator_id=? OR recipient_id=?", [user_id, user_id]).fetchall()
+            return [FriendEdge(row['id'], row['initiator_id'], row['recipient_id'], row['accepted'] == 1, row['established_date']) for row in rows]
+
+        return friend_graph.get(user_id, load_edges)
 
     @staticmethod
-    def get_friendships_for_user(user: User):
+    def from_edges(edges):
+        """
+        :param edges: a list of FriendEdges from the friend graph cache
+        :return: a list of Friendship objects for the edges, created without querying the database
+        """
+        return Friendship.from_rows([edge._asdict() for edge in edges])
 
-        # Returns a list of all Friendship objects for the specified user, whether accepted or not
+    @staticmethod
+    def get_friendships_for_user(user: User, limit=None, after=None):
+        """
+        :param user: the User whose friendships are to be returned
+        :param limit: the maximum number of friendships to return, or None for all of them
+        :param after: the next_cursor of the previous Page, or None for the first page
+        :return: a Page of all Friendship objects for the specified user, whether accepted or not, most recent first
+        """
 
-        friendships_list = []
+        friendship_rows, next_cursor = select_page(
+            Friendship.select_sql + " WHERE (initiator_id = :user_id OR recipient_id = :user_id)", {'user_id': user.id},
+            ["established_date", "id"], after, limit)
 
-        cur = get_db().cursor()
+        return Page(Friendship.from_rows(friendship_rows), next_cursor)
 
-        friendship_rows = cur.execute("SELECT * FROM Friendship WHERE initiator_id=? OR recipient_id=?", [user.id, user.id])
+    def accept(self, recipient: User):
 
-        for row in friendship_rows:
+        if self.__recipient_id == recipient.id and not self.__accepted:  # Only the recipient should be able to accept the friendship
 
-            friendships_list.append(Friendship(row['id']))
+            # The initiator and recipient now count as mutual friends of each other's friends. This is committed
+            # together with the Friendship by update_in_db.
 
-        return friendships_list
+            initiator_friends = Friendship.get_adjacency(self.initiator_id).friends
+            recipient_friends = Friendship.get_adjacency(self.recipient_id).friends
 
-    def accept(self, recipient: User):
+            suggestions.update_mutual_counts(get_db(), self.initiator_id, self.recipient_id, initiator_friends,
+                                             recipient_friends, 1)
 
-        if self.__recipient.id == recipient.id:  # Only the recipient should be able to accept the friendship
             self.__accepted = True
             self.__established_date = str(datetime.utcnow())
             self.update_in_db()
 
+            cache.notify('friendships_changed', self.initiator_id, self.recipient_id, *(initiator_friends | recipient_friends))
+            timelines.friendship_accepted_later(self.initiator_id, self.recipient_id)
+
     def revoke(self, user: User):
 
         # Need to use id property as the passed User object will not be the same actual object, it will be a new
@@ -310,7 +835,7 @@ class Friendship(FBObject):
 
         # Only the recipient or initiator of the Friendship is able to revoke it.
 
-        if self.recipient.id == user.id or self.initiator.id == user.id:
+        if self.recipient_id == user.id or self.initiator_id == user.id:
 
             # TODO: Add code to delete friendship from DB
 
@@ -318,16 +843,30 @@ class Friendship(FBObject):
 
             cur = db.cursor()
 
+            affected_ids = {self.initiator_id, self.recipient_id}
+
+            if self.accepted:
+                initiator_friends = Friendship.get_adjacency(self.initiator_id).friends
+                recipient_friends = Friendship.get_adjacency(self.recipient_id).friends
+                suggestions.update_mutual_counts(db, self.initiator_id, self.recipient_id, initiator_friends,
+                                                 recipient_friends, -1)
+                affected_ids |= initiator_friends | recipient_friends
+
             cur.execute("DELETE FROM Friendship WHERE id=?", [self.__id])
 
             db.commit()
 
+            self.forget()
+            friend_graph.invalidate(self.initiator_id, self.recipient_id)
+            cache.notify('friendships_changed', *affected_ids)
+
+            if self.accepted:
+                timelines.friendship_revoked_later(self.initiator_id, self.recipient_id)
+
     @staticmethod
     def get_friendship_for_users(a: User, b: User):
 
-        friendship_data = get_db().execute(
-            "SELECT id FROM Friendship WHERE (initiator_id=? and recipient_id=?) or (initiator_id=? AND recipient_id=?)",
-            [a.id, b.id, b.id, a.id]).fetchone()
+        friendship_data = get_db().execute("SELECT id FROM Friendship WHERE " + Friendship.pair_sql, {'a': a.id, 'b': b.id}).fetchone()
 
         if friendship_data:
 
@@ -340,25 +879,29 @@ class Friendship(FBObject):
     @staticmethod
     def initiate_friendship(initiator: User, recipient: User):
 
-        try:
+        existing_friendship = Friendship.get_friendship_for_users(initiator, recipient)
 
-            existing_friendship = Friendship.get_friendship_for_users(initiator, recipient)
+        if existing_friendship:
 
             return existing_friendship
 
-        except FriendshipDoesNotExist:
+        db = get_db()
+
+        cur = db.cursor()
 
-            db = get_db()
+        cur.execute("INSERT INTO Friendship VALUES (NULL, ?, ?, 0, ?)", [initiator.id, recipient.id, str(datetime.utcnow())])
 
-            cur = db.cursor()
+        friendship_id = cur.lastrowid
 
-            cur.execute("INSERT INTO Friendship VALUES (NULL, ?, ?, 0, ?)", [initiator.id, recipient.id, str(datetime.utcnow())])
+        db.commit()
 
-            friendship_id = cur.lastrowid
+        friend_graph.invalidate(initiator.id, recipient.id)
+        cache.notify('friendships_changed', initiator.id, recipient.id)
 
-            db.commit()
+        push_hub.publish(recipient.id, 'friendship_invitation', {'friendship_id': friendship_id, 'initiator_id': initiator.id,
+                                                                 'initiator_username': initiator.username})
 
-            return Friendship(friendship_id)
+        return Friendship(friendship_id)
 
     def update_in_db(self):
 
@@ -370,6 +913,8 @@ class Friendship(FBObject):
 
         db.commit()
 
+        friend_graph.invalidate(self.initiator_id, self.recipient_id)
+
     def __repr__(self):
         return "<Friendship object between User {} ({}) and User {} ({}). Friendship accepted: {}, established: {}>"\
             .format(self.initiator.id, self.initiator.username, self.recipient.id, self.recipient.username, self.accepted,
@@ -380,6 +925,19 @@ class Friendship(FBObject):
             .format(self.initiator.id, self.initiator.username, self.recipient.id, self.recipient.username, self.accepted,
                     self.established_date)
 
+    def get_dictionary(self):
+        return {
+            'id': self.id,
+            'initiator_id': self.initiator_id,
+            'recipient_id': self.recipient_id,
+            'accepted': self.accepted,
+            'established_date': self.established_date
+        }
+
+    @staticmethod
+    def row_dictionary(row):
+        return dict(row, accepted=row['accepted'] == 1)
+
 
 """
 Post class and related exceptions
@@ -390,46 +948,108 @@ class PostIDNotFoundException(Exception):
     pass
 
 
+# A Post to be written by Post.create_many. media_id is the id of a Media row saved with media_store.save_upload, and
+# tagged_users is a list of Users.
+NewPost = namedtuple('NewPost', ['author', 'text', 'media_id', 'tagged_users', 'public'], defaults=[None, (), False])
+
+
 class Post(FBObject):
 
-    def __init__(self, id):
+    __slots__ = ('__id', '__author_id', '__text', '__timestamp', '__public', '__media_file_path', '__likes_count',
+                 '__tags_count', '_lazy_author', '_lazy_likes', '_lazy_tagged_users')
 
-        db = get_db()
+    select_sql = "SELECT Post.*, Media.file_path FROM Post LEFT JOIN Media ON Post.media_id = Media.id"
+
+    dictionary_sql = "SELECT Post.id, Post.author_id, Post.text, Media.file_path AS media_file_path, Post.timestamp, " \
+                     "Post.public, Post.likes_count, Post.tags_count " \
+                     "FROM Post LEFT JOIN Media ON Post.media_id = Media.id"
+
+    # Condition that a Post is visible to the User with id :viewer_id; it must be public, written by the viewer or
+    # written by someone the viewer has an accepted friendship with
+    visible_to_viewer_sql = "(Post.public = 1 OR Post.author_id = :viewer_id OR EXISTS (" \
+                            "SELECT 1 FROM Friendship WHERE Friendship.accepted = 1 AND (" \
+                            "(Friendship.initiator_id = :viewer_id AND Friendship.recipient_id = Post.author_id) OR " \
+                            "(Friendship.recipient_id = :viewer_id AND Friendship.initiator_id = Post.author_id))))"
+
+    # The ids of the User with id :viewer_id and all of their accepted friends, i.e. the authors shown in their feed
+    feed_author_ids_sql = "SELECT :viewer_id " \
+                          "UNION ALL SELECT recipient_id FROM Friendship WHERE accepted = 1 AND initiator_id = :viewer_id " \
+                          "UNION ALL SELECT initiator_id FROM Friendship WHERE accepted = 1 AND recipient_id = :viewer_id"
+
+    # The Posts in the precomputed Timeline of the User with id :viewer_id (see timeline.py), read in the order of its
+    # primary key
+    timeline_sql = "SELECT Post.*, Media.file_path, Timeline.post_id FROM Timeline CROSS JOIN Post ON Post.id = Timeline.post_id " \
+                   "LEFT JOIN Media ON Post.media_id = Media.id WHERE Timeline.user_id = :viewer_id"
+
+    # Posts visible to :viewer_id whose text matches the full-text query :query, best matches first
+    search_sql = select_sql + " JOIN PostSearch ON PostSearch.rowid = Post.id WHERE PostSearch MATCH :query AND " + \
+                 visible_to_viewer_sql + " ORDER BY PostSearch.rank LIMIT :limit"
+
+    def __init__(self, id, post_data=None):
+
+        if self.loaded:
+            return  # Already loaded during this request
 
-        #post_data = db.execute("SELECT Post.*, Media.file_path FROM Post, Media WHERE Post.media_id = Media.id AND Post.id=?", [id]).fetchone()
-        post_data = db.execute(
-            "SELECT * FROM Post WHERE id=?", [id]).fetchone()
+        if post_data is None:
+            post_data = get_read_db().execute(Post.select_sql + " WHERE Post.id=?", [id]).fetchone()
 
         if post_data:
 
             self.__id = int(id)
+            self.__author_id = post_data['author_id']
             self.__text = post_data['text']
             self.__timestamp = post_data['timestamp']
             self.__public = True if post_data['public'] == 1 else False
+            self.__media_file_path = post_data['file_path']
+            self.__likes_count = post_data['likes_count']
+            self.__tags_count = post_data['tags_count']
 
-            self.__media_file_path = None
+            self.remember()
 
-            media_data = db.execute("SELECT file_path FROM Media WHERE id = ?", [post_data['media_id']]).fetchone()
+        else:
+            raise PostIDNotFoundException
 
-            if media_data:
+    @staticmethod
+    def get_user_ids_for_posts(posts, table, user_column):
+        """
+        :return: a dictionary mapping the id of each of posts to a list of the user ids in user_column of table (i.e.
+        PostLike or Tag) for that post, selected with one query per chunk of posts
+        """
 
-                self.__media_file_path = media_data['file_path']
+        user_ids = {post.id: [] for post in posts}
+        post_ids = list(user_ids.keys())
 
-            self.__author = User(post_data['author_id'])
-            self.__likes = self.get_likes()
-            self.__tagged_users = self.get_tagged_users()
+        for chunk in chunks(post_ids):
+            rows = get_read_db().execute("SELECT post_id, {} FROM {} WHERE post_id IN ({})".format(user_column, table, placeholders(chunk)), chunk)
+            for row in rows:
+                user_ids[row['post_id']].append(row[user_column])
 
+        return user_ids
 
-        else:
-            raise PostIDNotFoundException
+    @lazy_relationship
+    def author(posts):
+        User.load_many([post.author_id for post in posts])
+        return [User(post.author_id) for post in posts]
+
+    @lazy_relationship
+    def likes(posts):
+        like_ids = Post.get_user_ids_for_posts(posts, "PostLike", "user_id")
+        User.load_many([user_id for post in posts for user_id in like_ids[post.id]])
+        return [[User(user_id) for user_id in like_ids[post.id]] for post in posts]
+
+    @lazy_relationship
+    def tagged_users(posts):
+        tag_ids = Post.get_user_ids_for_posts(posts, "Tag", "tagged_user_id")
+        User.load_many([user_id for post in posts for user_id in tag_ids[post.id]])
+        return [[User(user_id) for user_id in tag_ids[post.id]] for post in posts]
 
     @property
     def id(self):
         return self.__id
 
     @property
-    def author(self):
-        return self.__author
+    def author_id(self):
+        return self.__author_id
 
     @property
     def text(self):
@@ -447,98 +1067,642 @@ class Post(FBObject):
     def public(self):
         return self.__public
 
-    @property
-    def likes(self):
-        return self.__likes
-
     @property
     def likes_count(self):
-        return len(self.__likes)
+        return self.__likes_count
 
     @property
-    def tagged_users(self):
-        return self.__tagged_users
+    def tags_count(self):
+        return self.__tags_count
+
+    def get_dictionary(self):
+        return {
+            'id': self.id,
+            'author_id': self.author_id,
+            'text': self.text,
+            'media_file_path': self.media_file_path,
+            'timestamp': self.timestamp,
+            'public': self.public,
+            'likes_count': self.likes_count,
+            'tags_count': self.tags_count
+        }
+
+    @staticmethod
+    def row_dictionary(row):
+        return dict(row, public=row['public'] == 1)
+
+    def like(self, user: User):
+        """
+        Records that user likes this Post, keeping the Post's likes_count up to date in the same transaction
+        :return: True if user had not already liked the Post
+        """
+
+        db = get_db()
+
+        liked = db.execute("INSERT OR IGNORE INTO PostLike (post_id, user_id) VALUES (?, ?)", [self.id, user.id]).rowcount == 1
+
+        if liked:
+            db.execute("UPDATE Post SET likes_count = likes_count + 1 WHERE id=?", [self.id])
+
+        db.commit()
+
+        if liked:
+            self.__likes_count += 1
+            if Post.likes.is_loaded(self):
+                self.likes.append(user)
+
+            if user.id != self.author_id:
+                push_hub.publish(self.author_id, 'like', {'post_id': self.id, 'user_id': user.id, 'username': user.username,
+                                                          'likes_count': self.__likes_count})
+
+        return liked
+
+    def unlike(self, user: User):
+        """
+        Removes user's like from this Post, keeping the Post's likes_count up to date in the same transaction
+        :return: True if user had liked the Post
+        """
+
+        db = get_db()
+
+        unliked = db.execute("DELETE FROM PostLike WHERE post_id=? AND user_id=?", [self.id, user.id]).rowcount == 1
+
+        if unliked:
+            db.execute("UPDATE Post SET likes_count = likes_count - 1 WHERE id=?", [self.id])
+
+        db.commit()
+
+        if unliked:
+            self.__likes_count -= 1
+            if Post.likes.is_loaded(self):
+                Post.likes.prime(self, [liker for liker in self.likes if liker.id != user.id])
+
+        return unliked
+
+    def tag(self, user: User):
+        """
+        Tags user in this Post, keeping the Post's tags_count up to date in the same transaction
+        :return: True if user was not already tagged
+        """
+
+        db = get_db()
+
+        tagged = db.execute("INSERT OR IGNORE INTO Tag (post_id, tagged_user_id) VALUES (?, ?)", [self.id, user.id]).rowcount == 1
+
+        if tagged:
+            db.execute("UPDATE Post SET tags_count = tags_count + 1 WHERE id=?", [self.id])
+
+        db.commit()
+
+        if tagged:
+            self.__tags_count += 1
+            if Post.tagged_users.is_loaded(self):
+                self.tagged_users.append(user)
+
+        return tagged
 
-    def get_likes(self):
+    def untag(self, user: User):
         """
-        :return: a list of Users who have liked the post
+        Removes the tag of user from this Post, keeping the Post's tags_count up to date in the same transaction
+        :return: True if user was tagged
         """
 
-        cur = get_db().cursor()
+        db = get_db()
+
+        untagged = db.execute("DELETE FROM Tag WHERE post_id=? AND tagged_user_id=?", [self.id, user.id]).rowcount == 1
+
+        if untagged:
+            db.execute("UPDATE Post SET tags_count = tags_count - 1 WHERE id=?", [self.id])
+
+        db.commit()
+
+        if untagged:
+            self.__tags_count -= 1
+            if Post.tagged_users.is_loaded(self):
+                Post.tagged_users.prime(self, [tagged_user for tagged_user in self.tagged_users if tagged_user.id != user.id])
+
+        return untagged
+
+    @staticmethod
+    def create(author: User, text, media_id=None, tagged_users=(), public=False):
+        """
+        :param author: the User writing the Post
+        :param media_id: the id of a Media row to attach to the Post, or None
+        :param tagged_users: a list of the Users to tag in the Post
+        :param public: True if everyone can see the Post, rather than just the author's friends
+        :return: the new Post
+        """
+        return Post.create_many([NewPost(author, text, media_id, tagged_users, public)])[0]
+
+    @staticmethod
+    def create_many(new_posts):
+        """
+        Writes a batch of Posts, with their tags, in a single transaction. Each Post is added to its author's feed
+        straight away, and to their friends' feeds by the timeline worker. Tagged Users are notified.
+        :param new_posts: a list of NewPosts
+        :return: a list of the new Posts, in the same order, with their author, likes and tagged Users already loaded
+        """
 
-        like_rows = cur.execute("SELECT user_id FROM PostLike WHERE post_id=?", [self.id]).fetchall()
+        if not new_posts:
+            return []
 
-        like_users = []
+        db = get_db()
+        timestamp = str(datetime.utcnow())
+
+        # The file paths of the media, so that the Posts can be populated without selecting them again afterwards
+        media_ids = unique_ids(new_post.media_id for new_post in new_posts)
+        media_paths = {}
+
+        for chunk in chunks(media_ids):
+            for row in db.execute("SELECT id, file_path FROM Media WHERE id IN ({})".format(placeholders(chunk)), chunk):
+                media_paths[row['id']] = row['file_path']
+
+        tagged_users = [list({user.id: user for user in new_post.tagged_users}.values()) for new_post in new_posts]
+
+        with db:
+
+            db.executemany("INSERT INTO Post (author_id, text, media_id, timestamp, public, likes_count, tags_count) "
+                           "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                           [(new_post.author.id, new_post.text, new_post.media_id, timestamp, int(bool(new_post.public)),
+                             len(tagged)) for new_post, tagged in zip(new_posts, tagged_users)])
+
+            # Nothing else can write while this transaction is open, so the new Posts have the highest ids
+            first_id = db.execute("SELECT MAX(id) FROM Post").fetchone()[0] - len(new_posts) + 1
+            post_ids = range(first_id, first_id + len(new_posts))
+
+            db.executemany("INSERT INTO Tag (post_id, tagged_user_id) VALUES (?, ?)",
+                           [(post_id, user.id) for post_id, tagged in zip(post_ids, tagged_users) for user in tagged])
 
-        for row in like_rows:
-            like_users.append(User(row['user_id']))
+            # The author sees their own Post at once; the worker adds it for everyone else (and ignores this row)
+            db.executemany("INSERT OR IGNORE INTO Timeline (user_id, timestamp, post_id, author_id) VALUES (?, ?, ?, ?)",
+                           [(new_post.author.id, timestamp, post_id, new_post.author.id) for post_id, new_post in zip(post_ids, new_posts)])
 
-        return like_users
+        posts = Post.from_rows([{'id': post_id, 'author_id': new_post.author.id, 'text': new_post.text, 'timestamp': timestamp,
+                                 'public': int(bool(new_post.public)), 'file_path': media_paths.get(new_post.media_id),
+                                 'likes_count': 0, 'tags_count': len(tagged)}
+                                for post_id, new_post, tagged in zip(post_ids, new_posts, tagged_users)])
+
+        for post, new_post, tagged in zip(posts, new_posts, tagged_users):
+
+            Post.author.prime(post, new_post.author)
+            Post.likes.prime(post, [])
+            Post.tagged_users.prime(post, tagged)
+
+            timelines.add_post_later(post.id)
+
+            for user in tagged:
+                if user.id != post.author_id:
+                    push_hub.publish(user.id, 'tag', {'post_id': post.id, 'user_id': post.author_id,
+                                                      'username': new_post.author.username})
+
+        return posts
+
+    @staticmethod
+    def like_counts(post_ids):
+        """
+        :param post_ids: a list of Post ids
+        :return: a dictionary mapping each Post id to its number of likes, read from the Post rows in one query per
+        chunk of ids
+        """
+
+        counts = {}
+        post_ids = unique_ids(post_ids)
+
+        for chunk in chunks(post_ids):
+            for row in get_read_db().execute("SELECT id, likes_count FROM Post WHERE id IN ({})".format(placeholders(chunk)), chunk):
+                counts[row['id']] = row['likes_count']
+
+        return counts
+
+    @staticmethod
+    def get_liked_post_ids(viewer: User, post_ids):
+        """
+        :param viewer: the User viewing a page of Posts
+        :param post_ids: the ids of the Posts on the page
+        :return: the set of the ids in post_ids that viewer has liked, found with one query per chunk of ids
+        """
+
+        liked_ids = set()
+        post_ids = unique_ids(post_ids)
+
+        for chunk in chunks(post_ids):
+            rows = get_read_db().execute("SELECT post_id FROM PostLike WHERE user_id=? AND post_id IN ({})".format(placeholders(chunk)), [viewer.id] + chunk)
+            liked_ids.update(row['post_id'] for row in rows)
+
+        return liked_ids
+
+    def get_likes(self, limit=None, after=None):
+        """
+        :param limit: the maximum number of Users to return, or None for all of them
+        :param after: the next_cursor of the previous Page, or None for the first page
+        :return: a Page of Users who have liked the post
+        """
+
+        like_rows, next_cursor = select_page("SELECT user_id FROM PostLike WHERE post_id = :post_id", {'post_id': self.id},
+                                             ["user_id"], after, limit, descending=False)
+
+        return Page(User.load_many([row['user_id'] for row in like_rows]), next_cursor)
 
     def get_tagged_users(self):
         """
         :return: a list of users that are tagged in this Post
         """
 
-        tagged_users = []  # initialise empty list
-
-        cur = get_db().cursor()
+        cur = get_read_db().cursor()
 
         tag_rows = cur.execute("SELECT tagged_user_id FROM Tag WHERE post_id=?", [self.id]).fetchall()
 
-        for row in tag_rows:
-            tagged_users.append(User(row['tagged_user_id']))
-
-        return tagged_users
+        return User.load_many([row['tagged_user_id'] for row in tag_rows])
 
     def user_is_tagged(self, user):
 
-        return user in self.__tagged_users
+        return user.id in [tagged_user.id for tagged_user in self.tagged_users]
 
 
     @staticmethod
-    def get_tagged_posts_for_user(user: User):
+    def get_tagged_posts_for_user(user: User, limit=None, after=None):
 
         """
         :param user: A User object for whom tagged posts are to be retrieved
-        :return: A list of Post objects that user is tagged in
+        :param limit: the maximum number of posts to return, or None for all of them
+        :param after: the next_cursor of the previous Page, or None for the first page
+        :return: A Page of Post objects that user is tagged in, newest first
         """
 
-        tagged_posts = []
+        post_rows, next_cursor = select_page(
+            Post.select_sql + " JOIN Tag ON Tag.post_id = Post.id WHERE Tag.tagged_user_id = :user_id", {'user_id': user.id},
+            ["Post.timestamp", "Post.id"], after, limit)
 
-        cur = get_db().cursor()
+        return Page(Post.from_rows(post_rows), next_cursor)
 
-        post_rows = cur.execute("SELECT post_id FROM Tag WHERE tagged_user_id=?", [user.id]).fetchall()
+    @staticmethod
+    def get_user_posts(user: User, viewer: User = None, limit=None, after=None):
+        """
+        :param user: A User object that represents the author of posts to be returned;
+        :param viewer: A User object that represents the viewer. Only viewers that are friends with the author can see non-public posts.
+        :param limit: the maximum number of posts to return, or None for all of them
+        :param after: the next_cursor of the previous Page, or None for the first page
+        :return: A Page of Posts authored by user that viewer is allowed to see, newest first
+        """
+
+        post_rows, next_cursor = select_page(
+            Post.select_sql + " WHERE Post.author_id = :author_id AND " + Post.visible_to_viewer_sql,
+            {'author_id': user.id, 'viewer_id': viewer.id if viewer else None},
+            ["Post.timestamp", "Post.id"], after, limit)
+
+        return Page(Post.from_rows(post_rows), next_cursor)
+
+    @staticmethod
+    def get_home_feed(viewer: User, limit=FEED_PAGE_SIZE, after=None):
+        """
+        :param viewer: A User object for whom the feed is being shown
+        :param limit: the maximum number of posts to return
+        :param after: the next_cursor of the previous Page, or None for the first page
+        :return: A Page of the posts written by viewer and all of viewer's accepted friends, newest first. Viewers can
+        see all of their friends' posts, so no further visibility check is needed.
+        """
 
-        for row in post_rows:
+        # Most pages are read from viewer's Timeline alone. The posts of any friends who are pull authors are merged in,
+        # and once the Timeline runs out the rest of the feed is read from the Post table.
 
-            tagged_posts.append(Post(row['post_id']))
+        parameters = {'viewer_id': viewer.id}
 
-        return tagged_posts
+        post_rows, next_cursor = select_page(Post.timeline_sql, parameters, ["Timeline.timestamp", "Timeline.post_id"],
+                                             after, limit)
+        more = next_cursor is not None
+
+        if not more:
+            older_rows, next_cursor = select_page(
+                Post.select_sql + " WHERE Post.author_id IN (" + Post.feed_author_ids_sql + ")", parameters,
+                ["Post.timestamp", "Post.id"], (post_rows[-1]['timestamp'], post_rows[-1]['id']) if post_rows else after, limit)
+            post_rows += older_rows
+            more = next_cursor is not None
+
+        pull_author_ids = timelines.pull_author_ids(get_read_db())
+
+        if pull_author_ids:
+            pull_author_ids = sorted(pull_author_ids & Friendship.get_adjacency(viewer.id).friends)
+
+        if pull_author_ids:
+            author_parameters = {"author_{}".format(i): author_id for i, author_id in enumerate(pull_author_ids)}
+            pull_rows, next_cursor = select_page(
+                Post.select_sql + " WHERE Post.author_id IN ({})".format(",".join(":" + name for name in author_parameters)),
+                author_parameters, ["Post.timestamp", "Post.id"], after, limit)
+            post_rows += pull_rows
+            more = more or next_cursor is not None
+
+        # A post can be read from more than one of these, e.g. if its author became a pull author after writing it.
+        # Posts without a timestamp are sorted last, as SQLite sorts NULL below every other value.
+        post_rows = sorted({row['id']: row for row in post_rows}.values(),
+                           key=lambda row: (row['timestamp'] is not None, row['timestamp'] or '', row['id']), reverse=True)
+
+        if len(post_rows) > limit:
+            post_rows = post_rows[:limit]
+            more = True
+
+        next_cursor = (post_rows[-1]['timestamp'], post_rows[-1]['id']) if more and post_rows else None
+
+        return Page(Post.from_rows(post_rows), next_cursor)
 
     @staticmethod
-    def get_user_posts(user: User, viewer: User = None):
+    def search(search_text, viewer: User = None, limit=20):
         """
-        :param user: A User object that represents the author of posts to be returned;
-        :param viewer: A User object that represents the viewer. Only viewers that are friends with the author can see non-public posts.
-        :return: A list of Posts authored by user
+        :param search_text: the text to search for in the text of posts
+        :param viewer: A User object that represents the viewer. Only posts that viewer is allowed to see are returned.
+        :param limit: the maximum number of posts to return
+        :return: A list of matching Posts, best matches first
+        """
+
+        query = full_text_query(search_text)
+
+        if query is None:
+            return []
+
+        post_rows = get_read_db().execute(Post.search_sql, {'query': query, 'viewer_id': viewer.id if viewer else None,
+                                                            'limit': limit}).fetchall()
+
+        return Post.from_rows(post_rows)
+
+
+"""
+ChatGroup and Message classes and related exceptions
+"""
+
+
+class ChatGroupIDNotFoundException(Exception):
+    pass
+
+
+class NotAChatGroupMemberException(Exception):
+    pass
+
+
+class ChatGroup(FBObject):
+
+    __slots__ = ('__id', '__name', '_lazy_members')
+
+    select_sql = "SELECT * FROM ChatGroup"
+
+    dictionary_sql = "SELECT id, name FROM ChatGroup"
+
+    def __init__(self, id, chatgroup_data=None):
+
+        if self.loaded:
+            return  # Already loaded during this request
+
+        if chatgroup_data is None:
+            chatgroup_data = get_read_db().execute(ChatGroup.select_sql + " WHERE id=?", [id]).fetchone()
+
+        if chatgroup_data:
+            self.__id = int(id)
+            self.__name = chatgroup_data['name']
+
+            self.remember()
+
+        else:
+            raise ChatGroupIDNotFoundException
+
+    @lazy_relationship
+    def members(chatgroups):
+        member_ids = {chatgroup.id: [] for chatgroup in chatgroups}
+        group_ids = list(member_ids.keys())
+
+        for chunk in chunks(group_ids):
+            rows = get_read_db().execute("SELECT chatgroup_id, user_id FROM ChatGroupMember WHERE chatgroup_id IN ({})".format(placeholders(chunk)), chunk)
+            for row in rows:
+                member_ids[row['chatgroup_id']].append(row['user_id'])
+
+        User.load_many([user_id for group_id in group_ids for user_id in member_ids[group_id]])
+        return [[User(user_id) for user_id in member_ids[chatgroup.id]] for chatgroup in chatgroups]
+
+    @property
+    def id(self):
+        return self.__id
+
+    @property
+    def name(self):
+        return self.__name
+
+    def __repr__(self):
+        return '<ChatGroup object: {}>'.format(self.id)
+
+    def get_dictionary(self):
+        return {
+            'id': self.id,
+            'name': self.name
+        }
+
+    @staticmethod
+    def create(name, members):
+        """
+        :param name: the name of the new ChatGroup
+        :param members: a list of the Users in the group
+        :return: the new ChatGroup
+        """
+
+        db = get_db()
+
+        chatgroup_id = db.execute("INSERT INTO ChatGroup VALUES (NULL, ?)", [name]).lastrowid
+        db.executemany("INSERT OR IGNORE INTO ChatGroupMember (chatgroup_id, user_id) VALUES (?, ?)",
+                       [(chatgroup_id, member.id) for member in members])
+
+        db.commit()
+
+        chatgroup = ChatGroup(chatgroup_id, {'id': chatgroup_id, 'name': name})
+        ChatGroup.members.prime(chatgroup, list(members))
+
+        return chatgroup
+
+    @staticmethod
+    def get_chatgroups_for_user(user: User):
+        """
+        :return: a list of (ChatGroup, number of unread messages) for every ChatGroup that user is a member of
+        """
+
+        rows = get_read_db().execute("SELECT ChatGroup.*, ChatGroupMember.unread_count FROM ChatGroup "
+                                     "JOIN ChatGroupMember ON ChatGroupMember.chatgroup_id = ChatGroup.id "
+                                     "WHERE ChatGroupMember.user_id=? ORDER BY ChatGroup.id", [user.id]).fetchall()
+
+        return list(zip(ChatGroup.from_rows(rows), [row['unread_count'] for row in rows]))
+
+    def is_member(self, user: User):
+
+        return get_read_db().execute("SELECT 1 FROM ChatGroupMember WHERE chatgroup_id=? AND user_id=?", [self.id, user.id]).fetchone() is not None
+
+    def get_messages(self, after_id=0, limit=MESSAGE_PAGE_SIZE):
+        """
+        :param after_id: the id of the last Message the caller already has, so that only newer ones are returned
+        :param limit: the maximum number of Messages to return
+        :return: a Page of the Messages in this group with an id greater than after_id, oldest first. Polling
+        clients pass the id of the last Message they received, so each poll only reads new rows.
         """
-        user_posts = []
 
-        cur = get_db().cursor()
+        message_rows, next_cursor = select_page(Message.select_sql + " WHERE chatgroup_id = :chatgroup_id",
+                                                {'chatgroup_id': self.id}, ["id"], (after_id,), limit, descending=False)
 
-        user_post_rows = cur.execute("SELECT id, public, author_id FROM Post WHERE author_id=?", [user.id]).fetchall()
+        return Page(Message.from_rows(message_rows), next_cursor)
 
-        for row in user_post_rows:
+    def get_earlier_messages(self, before_id=None, limit=MESSAGE_PAGE_SIZE):
+        """
+        :param before_id: the id of the earliest Message the caller already has, or None for the latest Messages
+        :param limit: the maximum number of Messages to return
+        :return: a Page of the Messages in this group before before_id, newest first, for scrolling back through history
+        """
+
+        message_rows, next_cursor = select_page(Message.select_sql + " WHERE chatgroup_id = :chatgroup_id",
+                                                {'chatgroup_id': self.id}, ["id"],
+                                                (before_id,) if before_id else None, limit)
+
+        return Page(Message.from_rows(message_rows), next_cursor)
 
-            # If the post is public or if the viewer is the author of the post
+    def post_message(self, author: User, text):
+
+        return self.post_messages(author, [text])[0]
+
+    def post_messages(self, author: User, texts):
+        """
+        Adds a batch of Messages to this group in a single transaction, and adds them to the unread count of every
+        other member
+        :return: a list of the new Messages
+        """
 
-            if row['public'] == 1 or (viewer and row['author_id'] == int(viewer.id)):
+        if not self.is_member(author):
+            raise NotAChatGroupMemberException
 
-                user_posts.append(Post(row['id']))
+        if not texts:
+            return []
+
+        db = get_db()
+        timestamp = str(datetime.utcnow())
+
+        db.executemany("INSERT INTO Message (chatgroup_id, author_id, text, timestamp) VALUES (?, ?, ?, ?)",
+                       [(self.id, author.id, text, timestamp) for text in texts])
+
+        # Nothing else can write while this transaction is open, so the new Messages have the highest ids
+        last_id = db.execute("SELECT MAX(id) FROM Message").fetchone()[0]
+
+        db.execute("UPDATE ChatGroupMember SET unread_count = unread_count + ? WHERE chatgroup_id=? AND user_id != ?",
+                   [len(texts), self.id, author.id])
+
+        db.commit()
 
-            elif viewer and viewer.isFriend(user):
+        first_id = last_id - len(texts) + 1
+
+        messages = Message.from_rows([{'id': first_id + i, 'chatgroup_id': self.id, 'author_id': author.id, 'text': text,
+                                       'timestamp': timestamp} for i, text in enumerate(texts)])
+
+        for member in self.members:
+            if member.id != author.id:
+                push_hub.publish(member.id, 'message', {'messages': [message.get_dictionary() for message in messages]})
+
+        return messages
+
+    def mark_read(self, user: User, message_id=None):
+        """
+        Records that user has read the Messages in this group up to and including message_id (or all of them if None)
+        """
+
+        db = get_db()
+
+        if message_id is None:
+            message_id = db.execute("SELECT MAX(id) FROM Message WHERE chatgroup_id=?", [self.id]).fetchone()[0] or 0
+
+        db.execute("UPDATE ChatGroupMember SET last_read_message_id = :message_id, unread_count = "
+                   "(SELECT COUNT(*) FROM Message WHERE chatgroup_id = :chatgroup_id AND id > :message_id AND author_id != :user_id) "
+                   "WHERE chatgroup_id = :chatgroup_id AND user_id = :user_id AND last_read_message_id < :message_id",
+                   {'message_id': message_id, 'chatgroup_id': self.id, 'user_id': user.id})
+
+        db.commit()
+
+    def get_unread_count(self, user: User):
+
+        row = get_read_db().execute("SELECT unread_count FROM ChatGroupMember WHERE chatgroup_id=? AND user_id=?", [self.id, user.id]).fetchone()
+
+        if not row:
+            raise NotAChatGroupMemberException
+
+        return row['unread_count']
+
+
+class MessageIDNotFoundException(Exception):
+    pass
+
+
+class Message(FBObject):
+
+    __slots__ = ('__id', '__chatgroup_id', '__author_id', '__text', '__timestamp', '_lazy_author')
+
+    select_sql = "SELECT * FROM Message"
+
+    dictionary_sql = "SELECT id, chatgroup_id, author_id, text, timestamp FROM Message"
+
+    def __init__(self, id, message_data=None):
+
+        if self.loaded:
+            return  # Already loaded during this request
+
+        if message_data is None:
+            message_data = get_read_db().execute(Message.select_sql + " WHERE id=?", [id]).fetchone()
+
+        if message_data:
+            self.__id = int(id)
+            self.__chatgroup_id = message_data['chatgroup_id']
+            self.__author_id = message_data['author_id']
+            self.__text = message_data['text']
+            self.__timestamp = message_data['timestamp']
+
+            self.remember()
+
+        else:
+            raise MessageIDNotFoundException
+
+    @lazy_relationship
+    def author(messages):
+        User.load_many([message.author_id for message in messages])
+        return [User(message.author_id) for message in messages]
+
+    @property
+    def id(self):
+        return self.__id
+
+    @property
+    def chatgroup_id(self):
+        return self.__chatgroup_id
+
+    @property
+    def author_id(self):
+        return self.__author_id
+
+    @property
+    def text(self):
+        return self.__text
+
+    @property
+    def timestamp(self):
+        return self.__timestamp
+
+    def __repr__(self):
+        return '<Message object: {}>'.format(self.id)
+
+    def get_dictionary(self):
+        return {
+            'id': self.id,
+            'chatgroup_id': self.chatgroup_id,
+            'author_id': self.author_id,
+            'text': self.text,
+            'timestamp': self.timestamp
+        }
+
+
+"""
+Cache invalidation: the events that the write paths above notify the cache of, and the cached data each one affects
+"""
+def user_changed(user_id):
+    cache.delete(User.cache_key(user_id))
+    cache.bump(User.cache_key(user_id))  # e.g. rendered posts that show the User's name
 
-                user_posts.append(Post(row['id']))
+def friendships_changed(*user_ids):
+    cache.bump(*[User.friends_version_name(user_id) for user_id in set(user_ids)])  # e.g. friend suggestions
 
-        return user_posts
+cache.on('user_changed', user_changed)
+cache.on('friendships_changed', friendships_changed)
@@ -0,0 +1,94 @@
+"""
+friend_graph.py
+
+An in-process cache of the Friendship graph. For each User it holds the Users they are friends with and their pending
+invitations in both directions, so that checking a friendship or listing invitations does not need to query the
+database. A User's entry is loaded the first time it is needed and is dropped whenever one of their Friendships
+changes, to be loaded again on next use.
+"""
+from collections import namedtuple, OrderedDict
+import threading
+
+
+# One row of the Friendship table. Edges are immutable, so they can be shared between threads.
+FriendEdge = namedtuple('FriendEdge', ['id', 'initiator_id', 'recipient_id', 'accepted', 'established_date'])
+
+
+class UserAdjacency:
+    """The Friendships of a single User"""
+
+    def __init__(self, user_id, edges):
+        self.user_id = user_id
+        self.edges = {}  # id of the other User: FriendEdge
+        self.friends = set()  # ids of Users with an accepted Friendship
+        self.pending_in = set()  # ids of Users who have invited this User
+        self.pending_out = set()  # ids of Users this User has invited
+
+        for edge in edges:
+
+            other_id = edge.recipient_id if edge.initiator_id == user_id else edge.initiator_id
+            self.edges[other_id] = edge
+
+            if edge.accepted:
+                self.friends.add(other_id)
+            elif edge.recipient_id == user_id:
+                self.pending_in.add(other_id)
+            else:
+                self.pending_out.add(other_id)
+
+
+class FriendGraphCache:
+
+    def __init__(self, max_users):
+        """
+        :param max_users: the maximum number of Users to keep; the least recently used are dropped first
+        """
+        self.__max_users = max_users
+        self.__adjacencies = OrderedDict()
+        self.__generations = {}  # user id: number of times the User's entry has been invalidated
+        self.__clears = 0  # number of times the whole cache has been cleared
+        self.__lock = threading.Lock()
+
+    def get(self, user_id, load_edges):
+        """
+        :param user_id: the id of a User
+        :param load_edges: a function that returns a list of FriendEdges for all of the Friendships of a User, given
+        their id, used if the User's Friendships are not already cached
+        :return: the UserAdjacency for the User
+        """
+
+        user_id = int(user_id)
+
+        with self.__lock:
+            adjacency = self.__adjacencies.get(user_id)
+            if adjacency is not None:
+                self.__adjacencies.move_to_end(user_id)
+                return adjacency
+            generation = (self.__clears, self.__generations.get(user_id, 0))
+
+        adjacency = UserAdjacency(user_id, load_edges(user_id))
+
+        with self.__lock:
+
+            # Only cache what was loaded if the User's Friendships have not changed while it was being loaded
+
+            if (self.__clears, self.__generations.get(user_id, 0)) == generation:
+                self.__adjacencies[user_id] = adjacency
+                if len(self.__adjacencies) > self.__max_users:
+                    self.__adjacencies.popitem(last=False)
+
+        return adjacency
+
+    def invalidate(self, *user_ids):
+        """Drops the cached Friendships of each of user_ids, e.g. after a Friendship between them has changed"""
+        with self.__lock:
+            for user_id in user_ids:
+                user_id = int(user_id)
+                self.__adjacencies.pop(user_id, None)
+                self.__generations[user_id] = self.__generations.get(user_id, 0) + 1
+
+    def clear(self):
+        """Drops every cached User, e.g. after Friendships have been changed in bulk"""
+        with self.__lock:
+            self.__clears += 1
+            self.__adjacencies.clear()
@@ -0,0 +1,293 @@
+"""
+media.py
+
+Stores uploaded media such as profile pictures. Uploads are streamed to disk in chunks rather than being held in memory.
+Each file is named after the SHA-256 hash of its content, so a file uploaded twice is stored once and shares a Media row.
+
+Resized copies of images (Config.MEDIA_VARIANTS) are made by a pool of background threads. They are recorded in the
+MediaVariant table. This needs Pillow. Without it only the original files are stored, and they are used everywhere.
+
+Media files are served by the /media route in routes.py. Content-addressed files never change, so the path and ETag
+resolved for each are kept in a small LRU cache and browsers are told to cache them indefinitely.
+
+Media uploaded before content hashing was added can be hashed, deduplicated and resized with:
+
+    flask process-media
+"""
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib, os, sqlite3, threading, uuid
+
+import click
+from flask.cli import with_appcontext
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Variants are not generated
+
+# The number of bytes of an upload read and written at a time
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def hash_stream(stream, out=None):
+    """
+    :param stream: a binary file-like object, read to the end in chunks
+    :param out: an optional binary file that every chunk is also written to
+    :return: the hex SHA-256 hash of the content of stream
+    """
+    content_hash = hashlib.sha256()
+
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        content_hash.update(chunk)
+        if out is not None:
+            out.write(chunk)
+
+    return content_hash.hexdigest()
+
+
+# A media file to be served. etag is None if the Media has no content hash yet. immutable is True if the file at path
+# will never change, so it can be cached forever.
+MediaFile = namedtuple('MediaFile', ['path', 'etag', 'immutable'])
+
+
+class MediaStore:
+
+    def __init__(self, upload_folder, db_pool, variants, workers, logger, on_write=None, resolved_cache_size=1024):
+        """
+        :param upload_folder: the folder that media files are stored in
+        :param db_pool: the ConnectionPool for the primary database, used by the workers to record variants
+        :param variants: a dictionary of variant name: the maximum width and height of that variant in pixels
+        :param workers: the number of threads that generate variants
+        :param on_write: an optional function called after the workers commit variants
+        :param resolved_cache_size: the number of MediaFiles kept by resolve
+        """
+        self.__upload_folder = upload_folder
+        self.__db_pool = db_pool
+        self.__variants = variants
+        self.__logger = logger
+        self.__on_write = on_write
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix="media-worker")
+        self.__resolved_cache_size = resolved_cache_size
+        self.__resolved = OrderedDict()  # (media id, variant): MediaFile
+        self.__lock = threading.Lock()
+
+    def path(self, file_path):
+        """:return: the full path of a file_path stored in Media or MediaVariant"""
+        return os.path.join(self.__upload_folder, file_path)
+
+    def resolve(self, db, media_id, variant=None):
+        """
+        :param db: a database connection to look the Media up with, if it is not cached
+        :param variant: the name of a variant, or None for the original file
+        :return: the MediaFile to serve for the variant of the Media with media_id, or None if there is no such Media.
+        If the variant has not been made, the original file is returned instead, but not as immutable.
+        """
+
+        key = (int(media_id), variant)
+
+        with self.__lock:
+            media_file = self.__resolved.get(key)
+            if media_file is not None:
+                self.__resolved.move_to_end(key)
+                return media_file
+
+        row = db.execute("SELECT Media.file_path, Media.content_hash, MediaVariant.file_path AS variant_path FROM Media "
+                         "LEFT JOIN MediaVariant ON MediaVariant.media_id = Media.id AND MediaVariant.variant = ? "
+                         "WHERE Media.id = ?", [variant, media_id]).fetchone()
+
+        if row is None:
+            return None
+
+        if row['content_hash'] is None:
+            return MediaFile(self.path(row['file_path']), None, False)
+
+        if variant is not None and row['variant_path'] is None:
+            # The variant may be made later, so the original must not be cached in its place
+            return MediaFile(self.path(row['file_path']), row['content_hash'], False)
+
+        if variant is None:
+            media_file = MediaFile(self.path(row['file_path']), row['content_hash'], True)
+        else:
+            media_file = MediaFile(self.path(row['variant_path']), "{}-{}".format(row['content_hash'], variant), True)
+
+        with self.__lock:
+            self.__resolved[key] = media_file
+            if len(self.__resolved) > self.__resolved_cache_size:
+                self.__resolved.popitem(last=False)
+
+        return media_file
+
+    def __forget(self, media_id):
+        """Drops every cached MediaFile for a Media that has been deleted"""
+        with self.__lock:
+            for key in [key for key in self.__resolved if key[0] == int(media_id)]:
+                del self.__resolved[key]
+
+    def save_upload(self, db, upload, extension):
+        """
+        Streams an uploaded file to the upload folder and adds a Media row for it. If a file with the same content has
+        already been stored, the upload is discarded and the existing Media row is used instead. Variants are generated
+        in the background.
+
+        :param db: a connection to the primary database; the new Media row is committed
+        :param upload: the uploaded file, a werkzeug FileStorage
+        :param extension: the file extension to store the file with, e.g. 'jpg'
+        :return: the id of the Media row for the file
+        """
+
+        temp_path = self.path(".upload-{}".format(uuid.uuid4().hex))
+
+        try:
+            with open(temp_path, 'wb') as temp_file:
+                content_hash = hash_stream(upload.stream, temp_file)
+
+            row = db.execute("SELECT id FROM Media WHERE content_hash=?", [content_hash]).fetchone()
+            if row:
+                return row['id']
+
+            file_path = "{}.{}".format(content_hash, extension.lower())
+            os.replace(temp_path, self.path(file_path))
+
+            try:
+                with db:
+                    media_id = db.execute("INSERT INTO Media (file_path, content_hash) VALUES (?, ?)", [file_path, content_hash]).lastrowid
+
+            except sqlite3.IntegrityError:
+                # The same file was uploaded by another request at the same time, which has already added it
+                return db.execute("SELECT id FROM Media WHERE content_hash=?", [content_hash]).fetchone()['id']
+
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.generate_variants_later(media_id, file_path)
+
+        return media_id
+
+    def discard_upload(self, db, media_id):
+        """
+        Deletes a Media row added by save_upload, with its files, e.g. if the registration it was uploaded for fails.
+        Nothing is deleted if the Media is used by a User or Post, which happens when an identical file was already
+        stored.
+        """
+
+        file_paths = [row['file_path'] for row in db.execute("SELECT file_path FROM Media WHERE id=? UNION ALL "
+                                                              "SELECT file_path FROM MediaVariant WHERE media_id=?",
+                                                              [media_id, media_id])]
+
+        with db:
+            deleted = db.execute("DELETE FROM Media WHERE id=:id AND NOT EXISTS (SELECT 1 FROM User WHERE profile_pic_id=:id) "
+                                 "AND NOT EXISTS (SELECT 1 FROM Post WHERE media_id=:id)", {'id': media_id}).rowcount
+            if deleted:
+                db.execute("DELETE FROM MediaVariant WHERE media_id=?", [media_id])
+
+        if deleted:
+            self.__forget(media_id)
+            for file_path in file_paths:
+                if os.path.exists(self.path(file_path)):
+                    os.remove(self.path(file_path))
+
+    def generate_variants_later(self, media_id, file_path):
+        """Queues the generation of the variants of a Media file for the worker threads"""
+
+        if Image is None or not self.__variants:
+            return
+
+        future = self.__executor.submit(self.generate_variants, media_id, file_path)
+        future.add_done_callback(self.__log_failure)
+
+    def __log_failure(self, future):
+        if future.exception() is not None:
+            self.__logger.error("Failed to generate media variants", exc_info=future.exception())
+
+    def generate_variants(self, media_id, file_path):
+        """
+        Saves a resized copy of the Media file for each variant that is smaller than the original, and records them in
+        MediaVariant
+        :return: the number of variants saved
+        """
+
+        stem, extension = os.path.splitext(file_path)
+        rows = []
+
+        with Image.open(self.path(file_path)) as image:
+
+            for name, size in self.__variants.items():
+
+                if image.width <= size and image.height <= size:
+                    continue  # The original is already small enough to be used for this variant
+
+                variant = image.copy()
+                variant.thumbnail((size, size))
+                variant_path = "{}_{}{}".format(stem, name, extension)
+                variant.save(self.path(variant_path), format=image.format)
+
+                rows.append((media_id, name, variant_path, variant.width, variant.height))
+
+        if not rows:
+            return 0
+
+        db = self.__db_pool.checkout()
+
+        try:
+            with db:
+                # Only record the variants if the Media has not been discarded in the meantime
+                db.executemany("INSERT OR REPLACE INTO MediaVariant (media_id, variant, file_path, width, height) "
+                               "SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM Media WHERE id=?)",
+                               [row + (media_id,) for row in rows])
+        finally:
+            self.__db_pool.checkin(db)
+
+        if self.__on_write:
+            self.__on_write()
+
+        return len(rows)
+
+    def process_existing(self, db):
+        """
+        Hashes every Media file that does not have a content_hash yet and queues its variants. Media with the same
+        content as another Media row are merged into it.
+        :return: a tuple of the number of files hashed and the number of duplicates merged
+        """
+
+        hashed = merged = 0
+
+        for row in db.execute("SELECT id, file_path FROM Media WHERE content_hash IS NULL").fetchall():
+
+            if not os.path.exists(self.path(row['file_path'])):
+                continue
+
+            with open(self.path(row['file_path']), 'rb') as media_file:
+                content_hash = hash_stream(media_file)
+
+            duplicate_of = db.execute("SELECT id, file_path FROM Media WHERE content_hash=?", [content_hash]).fetchone()
+
+            with db:
+                if duplicate_of:
+                    db.execute("UPDATE User SET profile_pic_id=? WHERE profile_pic_id=?", [duplicate_of['id'], row['id']])
+                    db.execute("UPDATE Post SET media_id=? WHERE media_id=?", [duplicate_of['id'], row['id']])
+                    db.execute("DELETE FROM Media WHERE id=?", [row['id']])
+                    self.__forget(row['id'])
+                    merged += 1
+                else:
+                    db.execute("UPDATE Media SET content_hash=? WHERE id=?", [content_hash, row['id']])
+                    hashed += 1
+
+            if not duplicate_of:
+                self.generate_variants_later(row['id'], row['file_path'])
+            elif duplicate_of['file_path'] != row['file_path']:
+                os.remove(self.path(row['file_path']))
+
+        return hashed, merged
+
+
+@click.command('process-media')
+@with_appcontext
+def process_media_command():
+    """Hash, deduplicate and generate variants of media uploaded before content hashing."""
+    from app import get_db, media_store
+    click.echo("Hashed {} media files and merged {} duplicates".format(*media_store.process_existing(get_db())))
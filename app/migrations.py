@@ -0,0 +1,277 @@
+"""
+migrations.py
+
+Versioned changes to the Fakebook database schema. The number of the last migration applied to a database is stored in
+SQLite's user_version pragma, so each migration is only applied once. To change the schema, add a new entry to the end
+of MIGRATIONS - never edit one that has already been released. Migrations hold their own copy of any SQL they share
+with the rest of the app, so that changing the app's queries later does not change what an old migration does.
+
+Also checks that the queries run by fb_objects.py are able to use an index, using EXPLAIN QUERY PLAN.
+"""
+from app.fb_objects import User, Post, Friendship, Message
+from app import app
+
+
+MIGRATIONS = [
+    (1, "Baseline schema", [
+        """CREATE TABLE IF NOT EXISTS `User` (
+            `id`	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            `username`	TEXT NOT NULL UNIQUE,
+            `email`	TEXT NOT NULL UNIQUE,
+            `password_hash`	TEXT NOT NULL,
+            `first_name`	TEXT NOT NULL,
+            `surname`	TEXT NOT NULL,
+            `joined`	TEXT NOT NULL,
+            `profile_pic_id`	INTEGER,
+            `bio`	TEXT DEFAULT 'A fatnastic FakeBook member!',
+            `dob`	TEXT,
+            `last_active`	TEXT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS `Post` (
+            `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `author_id`	INTEGER NOT NULL,
+            `text`	TEXT NOT NULL,
+            `media_id`	INTEGER,
+            `timestamp`	TEXT,
+            `public`	INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS `Media` (
+            `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `file_path`	TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS `PostLike` (
+            `post_id`	INTEGER,
+            `user_id`	INTEGER,
+            PRIMARY KEY(`post_id`,`user_id`)
+        )""",
+        """CREATE TABLE IF NOT EXISTS `Tag` (
+            `post_id`	INTEGER,
+            `tagged_user_id`	INTEGER,
+            PRIMARY KEY(`tagged_user_id`,`post_id`)
+        )""",
+        """CREATE TABLE IF NOT EXISTS `Friendship` (
+            `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `initiator_id`	INTEGER NOT NULL,
+            `recipient_id`	INTEGER NOT NULL,
+            `accepted`	INTEGER NOT NULL DEFAULT 0,
+            `established_date`	TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS `ChatGroup` (
+            `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `name`	TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS `ChatGroupMember` (
+            `chatgroup_id`	INTEGER,
+            `user_id`	INTEGER,
+            PRIMARY KEY(`chatgroup_id`,`user_id`)
+        )""",
+        """CREATE TABLE IF NOT EXISTS `Message` (
+            `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+            `chatgroup_id`	INTEGER NOT NULL,
+            `author_id`	INTEGER NOT NULL,
+            `text`	TEXT NOT NULL,
+            `timestamp`	TEXT NOT NULL
+        )""",
+    ]),
+    (2, "Indexes for the queries in fb_objects.py", [
+        # A User's posts, newest first (the rowid is implicitly the last column, so this also covers ORDER BY id)
+        "CREATE INDEX IF NOT EXISTS Post_author_timestamp ON Post(author_id, timestamp)",
+        # Friendships by either end, with accepted included so the feed's friend lookups never read the table
+        "CREATE INDEX IF NOT EXISTS Friendship_initiator ON Friendship(initiator_id, accepted, recipient_id)",
+        "CREATE INDEX IF NOT EXISTS Friendship_recipient ON Friendship(recipient_id, accepted, initiator_id)",
+        # The Friendship between a pair of Users, whichever of them initiated it
+        "CREATE INDEX IF NOT EXISTS Friendship_pair ON Friendship(min(initiator_id, recipient_id), max(initiator_id, recipient_id))",
+        # The primary key of Tag starts with tagged_user_id, so looking up the Users tagged in a Post needs its own index
+        "CREATE INDEX IF NOT EXISTS Tag_post ON Tag(post_id, tagged_user_id)",
+    ]),
+    (3, "Mutual friend counts for friend suggestions", [
+        """CREATE TABLE IF NOT EXISTS `FriendSuggestion` (
+            `user_id`	INTEGER NOT NULL,
+            `candidate_id`	INTEGER NOT NULL,
+            `mutual_count`	INTEGER NOT NULL,
+            PRIMARY KEY(`user_id`,`candidate_id`)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS FriendSuggestion_rank ON FriendSuggestion(user_id, mutual_count)",
+        "WITH Edge AS (SELECT initiator_id AS user_id, recipient_id AS friend_id FROM Friendship WHERE accepted = 1 "
+        "UNION ALL SELECT recipient_id, initiator_id FROM Friendship WHERE accepted = 1) "
+        "INSERT INTO FriendSuggestion (user_id, candidate_id, mutual_count) "
+        "SELECT a.user_id, b.user_id, COUNT(*) FROM Edge a JOIN Edge b ON a.friend_id = b.friend_id AND a.user_id != b.user_id "
+        "GROUP BY a.user_id, b.user_id",
+    ]),
+    (4, "Full-text search indexes for Users and Posts", [
+        # External content FTS5 tables, so the text is only stored once, in User and Post. Prefix indexes make
+        # searches for the start of a word (e.g. "Dim*") as fast as whole words.
+        "CREATE VIRTUAL TABLE IF NOT EXISTS UserSearch USING fts5(username, first_name, surname, "
+        "content='User', content_rowid='id', prefix='2 3')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS PostSearch USING fts5(text, content='Post', content_rowid='id', prefix='2 3')",
+        # Triggers keep the search indexes in step with the tables they index
+        """CREATE TRIGGER IF NOT EXISTS User_search_insert AFTER INSERT ON User BEGIN
+            INSERT INTO UserSearch(rowid, username, first_name, surname) VALUES (new.id, new.username, new.first_name, new.surname);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS User_search_delete AFTER DELETE ON User BEGIN
+            INSERT INTO UserSearch(UserSearch, rowid, username, first_name, surname) VALUES ('delete', old.id, old.username, old.first_name, old.surname);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS User_search_update AFTER UPDATE OF username, first_name, surname ON User BEGIN
+            INSERT INTO UserSearch(UserSearch, rowid, username, first_name, surname) VALUES ('delete', old.id, old.username, old.first_name, old.surname);
+            INSERT INTO UserSearch(rowid, username, first_name, surname) VALUES (new.id, new.username, new.first_name, new.surname);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS Post_search_insert AFTER INSERT ON Post BEGIN
+            INSERT INTO PostSearch(rowid, text) VALUES (new.id, new.text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS Post_search_delete AFTER DELETE ON Post BEGIN
+            INSERT INTO PostSearch(PostSearch, rowid, text) VALUES ('delete', old.id, old.text);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS Post_search_update AFTER UPDATE OF text ON Post BEGIN
+            INSERT INTO PostSearch(PostSearch, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO PostSearch(rowid, text) VALUES (new.id, new.text);
+        END""",
+        "INSERT INTO UserSearch(UserSearch) VALUES ('rebuild')",
+        "INSERT INTO PostSearch(PostSearch) VALUES ('rebuild')",
+    ]),
+    (5, "Like and tag counts stored on each Post", [
+        "ALTER TABLE Post ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE Post ADD COLUMN tags_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE Post SET likes_count = (SELECT COUNT(*) FROM PostLike WHERE PostLike.post_id = Post.id), "
+        "tags_count = (SELECT COUNT(*) FROM Tag WHERE Tag.post_id = Post.id)",
+        # Which of a page of Posts a User has liked
+        "CREATE INDEX IF NOT EXISTS PostLike_user ON PostLike(user_id, post_id)",
+    ]),
+    (6, "Chat read positions and unread counts", [
+        "ALTER TABLE ChatGroupMember ADD COLUMN last_read_message_id INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE ChatGroupMember ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE ChatGroupMember SET unread_count = (SELECT COUNT(*) FROM Message WHERE "
+        "Message.chatgroup_id = ChatGroupMember.chatgroup_id AND Message.author_id != ChatGroupMember.user_id)",
+        # A group's messages after (or before) a given id
+        "CREATE INDEX IF NOT EXISTS Message_chatgroup ON Message(chatgroup_id, id)",
+        # The groups a User is a member of
+        "CREATE INDEX IF NOT EXISTS ChatGroupMember_user ON ChatGroupMember(user_id, chatgroup_id)",
+    ]),
+    (7, "Media content hashes and resized variants", [
+        # Existing media are hashed by 'flask process-media'; NULLs do not conflict in a UNIQUE index
+        "ALTER TABLE Media ADD COLUMN content_hash TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS Media_content_hash ON Media(content_hash)",
+        """CREATE TABLE IF NOT EXISTS `MediaVariant` (
+            `media_id`	INTEGER NOT NULL,
+            `variant`	TEXT NOT NULL,
+            `file_path`	TEXT NOT NULL,
+            `width`	INTEGER NOT NULL,
+            `height`	INTEGER NOT NULL,
+            PRIMARY KEY(`media_id`,`variant`)
+        ) WITHOUT ROWID""",
+        # Whether a Media row is still used, before it is discarded
+        "CREATE INDEX IF NOT EXISTS User_profile_pic ON User(profile_pic_id)",
+        "CREATE INDEX IF NOT EXISTS Post_media ON Post(media_id)",
+    ]),
+    (8, "Precomputed home feed timelines", [
+        """CREATE TABLE IF NOT EXISTS `Timeline` (
+            `user_id`	INTEGER NOT NULL,
+            `timestamp`	TEXT NOT NULL,
+            `post_id`	INTEGER NOT NULL,
+            `author_id`	INTEGER NOT NULL,
+            PRIMARY KEY(`user_id`,`timestamp`,`post_id`)
+        ) WITHOUT ROWID""",
+        "CREATE TABLE IF NOT EXISTS `TimelinePullAuthor` (`user_id` INTEGER PRIMARY KEY)",
+        # Users with more friends than the fan-out limit
+        "INSERT INTO TimelinePullAuthor (user_id) SELECT user_id FROM ("
+        "SELECT initiator_id AS user_id, recipient_id AS friend_id FROM Friendship WHERE accepted = 1 "
+        "UNION ALL SELECT recipient_id, initiator_id FROM Friendship WHERE accepted = 1) "
+        "GROUP BY user_id HAVING COUNT(*) > {:d}".format(app.config['TIMELINE_FANOUT_LIMIT']),
+        # The newest Posts with a timestamp by each User and their friends who are not pull authors
+        "INSERT INTO Timeline (user_id, timestamp, post_id, author_id) "
+        "SELECT Reader.id, Post.timestamp, Post.id, Post.author_id FROM User AS Reader JOIN Post ON Post.id IN ("
+        "SELECT id FROM Post WHERE author_id IN (SELECT Reader.id UNION ALL SELECT friend_id FROM ("
+        "SELECT recipient_id AS friend_id FROM Friendship WHERE accepted = 1 AND initiator_id = Reader.id "
+        "UNION ALL SELECT initiator_id FROM Friendship WHERE accepted = 1 AND recipient_id = Reader.id) "
+        "WHERE friend_id NOT IN (SELECT user_id FROM TimelinePullAuthor)) AND timestamp IS NOT NULL "
+        "ORDER BY timestamp DESC, id DESC LIMIT {:d})".format(app.config['TIMELINE_MAX_LENGTH']),
+    ]),
+]
+
+
+def get_schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    """
+    Applies any migrations that have not yet been applied to db, each in its own transaction
+    :return: a list of the (version, description) of each migration applied
+    """
+
+    applied = []
+
+    for version, description, statements in MIGRATIONS:
+
+        if version <= get_schema_version(db):
+            continue
+
+        # sqlite3 only opens a transaction implicitly before INSERT, UPDATE and DELETE, so one is begun explicitly
+        # to make the CREATE and ALTER statements part of it too. A migration that fails is rolled back completely.
+        db.execute("BEGIN")
+        try:
+            for statement in statements:
+                db.execute(statement)
+            db.execute("PRAGMA user_version = {:d}".format(version))
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+        applied.append((version, description))
+
+    return applied
+
+
+# The queries run by fb_objects.py that are executed most often, with a description of each. Parameters are named so
+# that they can all be explained with the same (empty) values.
+HOT_QUERIES = [
+    ("Load a User", User.select_sql + " WHERE User.id = :id"),
+    ("Log in", "SELECT id, email, password_hash FROM User WHERE email = :email"),
+    ("Check username is available", "SELECT id FROM User WHERE username = :username"),
+    ("Load a Post", Post.select_sql + " WHERE Post.id = :id"),
+    ("Load the likes for Posts", "SELECT post_id, user_id FROM PostLike WHERE post_id IN (:id)"),
+    ("Like counts for Posts", "SELECT id, likes_count FROM Post WHERE id IN (:id)"),
+    ("Posts a User has liked", "SELECT post_id FROM PostLike WHERE user_id = :user_id AND post_id IN (:id)"),
+    ("Load the tags for Posts", "SELECT post_id, tagged_user_id FROM Tag WHERE post_id IN (:id)"),
+    ("Posts a User is tagged in", Post.select_sql + " JOIN Tag ON Tag.post_id = Post.id WHERE Tag.tagged_user_id = :user_id"
+                                  " ORDER BY Post.timestamp DESC, Post.id DESC"),
+    ("A User's posts", Post.select_sql + " WHERE Post.author_id = :author_id AND " + Post.visible_to_viewer_sql +
+                       " ORDER BY Post.timestamp DESC, Post.id DESC"),
+    ("Home feed timeline", Post.timeline_sql + " ORDER BY Timeline.timestamp DESC, Timeline.post_id DESC"),
+    ("Home feed", Post.select_sql + " WHERE Post.author_id IN (" + Post.feed_author_ids_sql + ")"
+                  " ORDER BY Post.timestamp DESC, Post.id DESC"),
+    ("A User's friendships", Friendship.select_sql + " WHERE (initiator_id = :user_id OR recipient_id = :user_id)"),
+    ("Friendship between two Users", Friendship.select_sql + " WHERE " + Friendship.pair_sql),
+    ("Friend suggestions", User.suggestions_sql),
+    ("Search for Users", User.search_sql),
+    ("Search for Posts", Post.search_sql),
+    ("New chat messages", Message.select_sql + " WHERE chatgroup_id = :id AND (id) > (:a) ORDER BY id LIMIT :limit"),
+    ("Find Media by content", "SELECT id FROM Media WHERE content_hash = :query"),
+    ("Media file to serve", "SELECT Media.file_path, MediaVariant.file_path FROM Media LEFT JOIN MediaVariant ON "
+                            "MediaVariant.media_id = Media.id AND MediaVariant.variant = :query WHERE Media.id = :id"),
+    ("Variants of Media", "SELECT media_id, variant, file_path FROM MediaVariant WHERE media_id IN (:id)"),
+    ("A User's chat groups", "SELECT ChatGroup.*, ChatGroupMember.unread_count FROM ChatGroup "
+                             "JOIN ChatGroupMember ON ChatGroupMember.chatgroup_id = ChatGroup.id "
+                             "WHERE ChatGroupMember.user_id = :user_id ORDER BY ChatGroup.id"),
+]
+
+
+def find_unindexed_queries(db):
+    """
+    :return: a list of (description, plan step) for each step of a HOT_QUERIES query plan that scans a whole table
+    """
+
+    unindexed = []
+
+    for description, sql in HOT_QUERIES:
+
+        parameters = {name: None for name in ['id', 'email', 'username', 'user_id', 'author_id', 'viewer_id', 'a', 'b', 'limit', 'query']
+                      if ':' + name in sql}
+
+        for step in db.execute("EXPLAIN QUERY PLAN " + sql, parameters):
+
+            # 'SCAN <table>' means every row of the table is read; scans of an index or a constant row are fine
+            if step['detail'].startswith('SCAN') and 'INDEX' not in step['detail'] and 'CONSTANT' not in step['detail']:
+                unindexed.append((description, step['detail']))
+
+    return unindexed
@@ -0,0 +1,148 @@
+"""
+passwords.py
+
+Password hashes are deliberately slow to compute. Hashing them on the request threads would let a burst of logins
+stall every thread at once. Here they are computed by a pool of worker processes instead, so that they also run in
+parallel rather than one at a time under the GIL.
+
+At most Config.PASSWORD_HASH_MAX_PENDING hashes can be waiting or running at once. Beyond that, requests are turned away
+rather than queued. Hashes made with other settings than Config.PASSWORD_HASH_METHOD are replaced on the User's next
+successful login. The number of login attempts for each email address is also limited, so that guessing one account's
+password cannot tie up the workers.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing, threading, time
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusyException(Exception):
+    pass
+
+
+class PasswordHasher:
+
+    def __init__(self, method, salt_length, workers, max_pending, wait_timeout):
+        """
+        :param method: the werkzeug hashing method with all of its cost parameters, e.g. 'scrypt:32768:8:1', so that it
+        can be compared with the start of a stored hash
+        :param salt_length: the number of characters of salt in new hashes
+        :param workers: the number of worker processes
+        :param max_pending: the maximum number of hashes waiting or being computed at once
+        :param wait_timeout: the number of seconds to wait for a place when max_pending are already waiting
+        """
+        self.__method = method
+        self.__salt_length = salt_length
+        self.__workers = workers
+        self.__wait_timeout = wait_timeout
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__executor = None
+        self.__executor_lock = threading.Lock()
+
+    def __get_executor(self):
+
+        # The processes are started when first needed, by which time the app's own threads (e.g. the last_active
+        # flush) are running. Forking would copy those in whatever state they were in, so the workers start from a
+        # fresh interpreter: from a fork server where there is one, and otherwise by spawning them (e.g. on Windows).
+        # They only import werkzeug's hashing functions and the main module, which must only start the app when it
+        # is run (see Fakebook.py).
+
+        with self.__executor_lock:
+            if self.__executor is None:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.__executor = ProcessPoolExecutor(self.__workers, mp_context=multiprocessing.get_context(method))
+            return self.__executor
+
+    def __run(self, function, *args):
+
+        if not self.__slots.acquire(timeout=self.__wait_timeout):
+            raise HashingBusyException
+
+        try:
+            future = self.__get_executor().submit(function, *args)
+        except Exception:
+            self.__slots.release()
+            raise
+
+        future.add_done_callback(lambda future: self.__slots.release())
+
+        return future.result()
+
+    def generate(self, password):
+        """:return: a new hash of password"""
+        return self.__run(generate_password_hash, password, self.__method, self.__salt_length)
+
+    def generate_many(self, passwords):
+        """
+        :return: a list of new hashes of each of passwords, computed by all of the workers at once. This is for bulk jobs
+        such as imports, not for request threads, as it does not wait for a place among max_pending.
+        """
+        chunksize = max(1, len(passwords) // (self.__workers * 4))
+        return list(self.__get_executor().map(generate_password_hash, passwords, repeat(self.__method),
+                                              repeat(self.__salt_length), chunksize=chunksize))
+
+    def check(self, password_hash, password):
+        """:return: True if password matches password_hash"""
+        return self.__run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """:return: True if password_hash was made with a different method or cost to the current settings"""
+        return password_hash.split('$', 1)[0] != self.__method
+
+    def shutdown(self):
+        with self.__executor_lock:
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+
+
+class RateLimiter:
+    """Allows each key (e.g. an email address) a limited number of attempts in a sliding window of time"""
+
+    def __init__(self, max_attempts, window):
+        """
+        :param max_attempts: the number of attempts allowed for each key within window
+        :param window: the length of the window in seconds
+        """
+        self.__max_attempts = max_attempts
+        self.__window = window
+        self.__attempts = {}  # key: deque of the times of its attempts within the window, oldest first
+        self.__lock = threading.Lock()
+        self.__next_cleanup = time.monotonic() + window
+
+    def attempt(self, key):
+        """
+        Records an attempt for key, unless it has already used all of its attempts in the window
+        :return: True if the attempt is allowed
+        """
+
+        now = time.monotonic()
+
+        with self.__lock:
+
+            if now >= self.__next_cleanup:
+                self.__remove_expired(now)
+
+            attempts = self.__attempts.setdefault(key, deque())
+
+            while attempts and attempts[0] <= now - self.__window:
+                attempts.popleft()
+
+            if len(attempts) >= self.__max_attempts:
+                return False
+
+            attempts.append(now)
+            return True
+
+    def reset(self, key):
+        """Forgets the attempts for key, e.g. once a User has logged in successfully"""
+        with self.__lock:
+            self.__attempts.pop(key, None)
+
+    def __remove_expired(self, now):
+        # Drop keys with no attempts in the window, so that the number of keys held does not keep growing
+        for key in [key for key, attempts in self.__attempts.items() if not attempts or attempts[-1] <= now - self.__window]:
+            del self.__attempts[key]
+        self.__next_cleanup = now + self.__window
@@ -0,0 +1,224 @@
+"""
+profiler.py
+
+Records every query run through the connections returned by get_db() and get_read_db(). The time taken, the number of
+rows returned and a fingerprint of the SQL are recorded for each query, grouped by request.
+
+When Config.QUERY_PROFILER_HEADERS is set, each response reports its totals in the X-Query-Count, X-Query-Rows and
+X-Query-Time headers. HTML pages also get a table of their queries appended when Config.QUERY_PROFILER_TOOLBAR is set.
+Both are for development, as they show every client how much work each page does. Totals for every endpoint and query since
+the app started are served in Prometheus text format at /metrics.
+
+A request that runs the same query QUERY_PROFILER_N_PLUS_ONE_THRESHOLD or more times is logged as a likely N+1 problem.
+That is one query per object where a single query for all of them would do.
+"""
+from collections import defaultdict
+from functools import lru_cache
+from html import escape
+import re, threading, time
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """
+    :return: sql with literal values replaced by ? and whitespace normalised, so that queries that differ only in
+    their values (including the number of values in an IN list) have the same fingerprint
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r":\w+", "?", sql)
+    sql = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class QueryStats:
+    """The number of times a query was run, with the total rows it returned and seconds it took"""
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, count, rows, seconds):
+        self.count += count
+        self.rows += rows
+        self.seconds += seconds
+
+
+class RequestProfile:
+    """The queries run while handling one request, by fingerprint"""
+
+    def __init__(self):
+        self.queries = defaultdict(QueryStats)
+        self.started = time.perf_counter()
+
+    @property
+    def total(self):
+        total = QueryStats()
+        for stats in self.queries.values():
+            total.add(stats.count, stats.rows, stats.seconds)
+        return total
+
+    def repeated_queries(self, threshold):
+        """:return: a list of (fingerprint, QueryStats) for the queries run at least threshold times"""
+        return [(sql, stats) for sql, stats in self.queries.items() if stats.count >= threshold]
+
+
+class ProfiledCursor:
+    """Wraps a sqlite3.Cursor, adding each query it runs and the rows fetched from it to a RequestProfile"""
+
+    def __init__(self, cursor, profile):
+        self.__cursor = cursor
+        self.__profile = profile
+        self.__stats = None
+
+    def __time(self, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.__stats.seconds += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        self.__stats = self.__profile.queries[fingerprint(sql)]
+        self.__stats.count += 1
+        self.__time(self.__cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.__stats = self.__profile.queries[fingerprint(sql)]
+        self.__stats.count += 1
+        self.__time(self.__cursor.executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        row = self.__time(self.__cursor.fetchone)
+        if row is not None:
+            self.__stats.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.__time(self.__cursor.fetchmany, size if size is not None else self.__cursor.arraysize)
+        self.__stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.__time(self.__cursor.fetchall)
+        self.__stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        # Rows are fetched one at a time as they are used, as they are when iterating over a sqlite3.Cursor
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)  # e.g. lastrowid, rowcount
+
+
+class ProfiledConnection:
+    """Wraps a sqlite3.Connection, so that every query run with it is added to a RequestProfile"""
+
+    def __init__(self, connection, profile):
+        self.__connection = connection
+        self.__profile = profile
+
+    def cursor(self):
+        return ProfiledCursor(self.__connection.cursor(), self.__profile)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def __enter__(self):
+        self.__connection.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.__connection.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self.__connection, name)  # e.g. commit, total_changes
+
+
+class QueryMetrics:
+    """Totals of the RequestProfiles of every request since the app started, by endpoint and by query"""
+
+    def __init__(self):
+        self.__requests = defaultdict(int)  # endpoint: number of requests
+        self.__request_queries = defaultdict(QueryStats)  # endpoint: queries run by its requests
+        self.__queries = defaultdict(QueryStats)  # fingerprint: totals
+        self.__n_plus_one = defaultdict(int)  # (endpoint, fingerprint): number of requests that repeated the query
+        self.__lock = threading.Lock()
+
+    def record(self, endpoint, profile, repeated):
+        """
+        :param endpoint: the name of the endpoint that handled the request
+        :param profile: the RequestProfile of the request
+        :param repeated: the fingerprints of any queries the request repeated too often
+        """
+        total = profile.total
+
+        with self.__lock:
+            self.__requests[endpoint] += 1
+            self.__request_queries[endpoint].add(total.count, total.rows, total.seconds)
+            for sql, stats in profile.queries.items():
+                self.__queries[sql].add(stats.count, stats.rows, stats.seconds)
+            for sql in repeated:
+                self.__n_plus_one[(endpoint, sql)] += 1
+
+    def render(self, gauges=()):
+        """
+        :param gauges: (name, help text, value) for each other current value to include, e.g. the state of the pool
+        :return: the metrics in Prometheus text exposition format
+        """
+
+        lines = []
+
+        def metric(name, help_text, metric_type, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(label, str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                      for label, label_value in labels)
+                lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+        with self.__lock:
+            metric("fakebook_requests_total", "Requests handled, by endpoint.", "counter",
+                   [((("endpoint", endpoint),), count) for endpoint, count in self.__requests.items()])
+            metric("fakebook_request_queries_total", "Queries run while handling requests, by endpoint.", "counter",
+                   [((("endpoint", endpoint),), stats.count) for endpoint, stats in self.__request_queries.items()])
+            metric("fakebook_request_query_seconds_total", "Time spent running queries while handling requests, by endpoint.", "counter",
+                   [((("endpoint", endpoint),), stats.seconds) for endpoint, stats in self.__request_queries.items()])
+            metric("fakebook_queries_total", "Times each query has been run.", "counter",
+                   [((("query", sql),), stats.count) for sql, stats in self.__queries.items()])
+            metric("fakebook_query_rows_total", "Rows returned by each query.", "counter",
+                   [((("query", sql),), stats.rows) for sql, stats in self.__queries.items()])
+            metric("fakebook_query_seconds_total", "Time spent running each query.", "counter",
+                   [((("query", sql),), stats.seconds) for sql, stats in self.__queries.items()])
+            metric("fakebook_n_plus_one_total", "Requests that ran the same query many times.", "counter",
+                   [((("endpoint", endpoint), ("query", sql)), count) for (endpoint, sql), count in self.__n_plus_one.items()])
+
+        for name, help_text, value in gauges:
+            metric(name, help_text, "gauge", [((), value)])
+
+        return "\n".join(lines) + "\n"
+
+
+def render_toolbar(profile, threshold):
+    """:return: an HTML table of the queries in profile, most time consuming first, to append to a page"""
+
+    total = profile.total
+    rows = "".join("<tr{}><td>{}</td><td>{}</td><td>{:.2f}</td><td><code>{}</code></td></tr>"
+                   .format(' style="background: #fdd"' if stats.count >= threshold else "", stats.count, stats.rows,
+                           stats.seconds * 1000, escape(sql))
+                   for sql, stats in sorted(profile.queries.items(), key=lambda item: -item[1].seconds))
+
+    return '<div id="query-profiler"><p>{} queries, {} rows, {:.2f} ms in the database, {:.2f} ms in total</p>' \
+           '<table><tr><th>Count</th><th>Rows</th><th>ms</th><th>Query</th></tr>{}</table></div>' \
+           .format(total.count, total.rows, total.seconds * 1000, (time.perf_counter() - profile.started) * 1000, rows)
@@ -0,0 +1,199 @@
+"""
+push.py
+
+Pushes events (new friendship invitations, likes and chat messages) to signed in users as they happen, so that browsers
+do not have to keep polling the Flask app for them.
+
+Events are published to a PushHub by fb_objects.py, which fans each one out to every connection the recipient has open.
+The connections are server-sent event streams handled by a small asyncio server that runs in a background thread of the
+same process as the Flask app, on Config.PUSH_SERVER_PORT. Each idle connection is just a coroutine waiting on a queue,
+so thousands of them cost very little. Browsers connect with:
+
+    new EventSource("http://<host>:<PUSH_SERVER_PORT>/events", {withCredentials: true})
+
+and are identified by the same session cookie as the Flask app.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+
+class PushHub:
+    """In-process publish/subscribe of events to users, keyed by User id"""
+
+    def __init__(self, queue_size):
+        """
+        :param queue_size: the number of undelivered events kept for each connection; further events for a
+        connection that is not keeping up are dropped
+        """
+        self.__queue_size = queue_size
+        self.__loop = None
+        self.__subscribers = defaultdict(set)  # user id: set of asyncio.Queue, one per open connection
+
+        # The number of open connections, read by other threads (e.g. for /metrics) while the loop changes subscribers
+        self.__connection_count = 0
+        self.__count_lock = threading.Lock()
+
+    def attach(self, loop):
+        """Sets the event loop that subscribers' connections are handled by"""
+        self.__loop = loop
+
+    def publish(self, user_id, event, data):
+        """
+        Sends an event to every open connection of the User with user_id. Can be called from any thread, and does
+        nothing if the push server is not running.
+
+        :param event: the name of the event, e.g. 'like'
+        :param data: a dictionary of data for the event, which must be serializable as JSON
+        """
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__deliver, int(user_id), event, json.dumps(data))
+
+    def __deliver(self, user_id, event, data):
+        for queue in self.__subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                pass
+
+    def subscribe(self, user_id):
+        """Called on the event loop when a connection opens; returns the queue its events are delivered to"""
+        queue = asyncio.Queue(self.__queue_size)
+        self.__subscribers[user_id].add(queue)
+        with self.__count_lock:
+            self.__connection_count += 1
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        """Called on the event loop when a connection closes"""
+        queues = self.__subscribers.get(user_id)
+        if queues is None or queue not in queues:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.__subscribers[user_id]
+        with self.__count_lock:
+            self.__connection_count -= 1
+
+    def connection_count(self):
+        """:return: the number of open connections. Can be called from any thread."""
+        with self.__count_lock:
+            return self.__connection_count
+
+
+class PushServer:
+
+    def __init__(self, app, hub, heartbeat_interval):
+        """
+        :param app: the Flask app, whose session cookies are used to identify users
+        :param hub: the PushHub that events are published to
+        :param heartbeat_interval: seconds between comments sent on idle connections, so proxies keep them open
+        """
+        self.__app = app
+        self.__hub = hub
+        self.__heartbeat_interval = heartbeat_interval
+
+    def get_user_id(self, headers):
+        """
+        :return: the id of the signed in User from the Flask session cookie in headers, or None
+        """
+        cookie = SimpleCookie(headers.get('cookie', ''))
+        session_cookie = cookie.get(self.__app.config['SESSION_COOKIE_NAME'])
+
+        if session_cookie is None:
+            return None
+
+        serializer = self.__app.session_interface.get_signing_serializer(self.__app)
+
+        try:
+            session = serializer.loads(session_cookie.value, max_age=int(self.__app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return None  # The cookie has been tampered with or has expired
+
+        return session.get('activeUserID')
+
+    async def handle_connection(self, reader, writer):
+
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if len(request_line) < 2 or request_line[0] != 'GET' or urlsplit(request_line[1]).path != '/events':
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            user_id = self.get_user_id(headers)
+
+            if user_id is None:
+                writer.write(b"HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            response_headers = ["HTTP/1.1 200 OK", "Content-Type: text/event-stream", "Cache-Control: no-cache",
+                                "Connection: keep-alive"]
+
+            # The push server is on a different port to the Flask app, so browsers treat it as another origin. Allow
+            # pages served from the same host to connect with their cookies.
+            origin = headers.get('origin')
+            if origin and urlsplit(origin).hostname == urlsplit('//' + headers.get('host', '')).hostname:
+                response_headers += ["Access-Control-Allow-Origin: " + origin, "Access-Control-Allow-Credentials: true"]
+
+            writer.write(("\r\n".join(response_headers) + "\r\n\r\n").encode('latin-1'))
+            await writer.drain()
+
+            queue = self.__hub.subscribe(int(user_id))
+
+            try:
+                while True:
+                    try:
+                        event, data = await asyncio.wait_for(queue.get(), self.__heartbeat_interval)
+                        writer.write("event: {}\ndata: {}\n\n".format(event, data).encode())
+                    except asyncio.TimeoutError:
+                        writer.write(b": heartbeat\n\n")
+                    await writer.drain()
+            finally:
+                self.__hub.unsubscribe(int(user_id), queue)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # The browser has gone away
+
+        finally:
+            writer.close()
+
+    def start(self, host, port):
+        """Runs the server on its own event loop in a daemon thread"""
+
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(loop)
+
+            try:
+                loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port))
+            except OSError as e:
+                errors.append(e)  # e.g. the port is already in use
+                started.set()
+                return
+
+            self.__hub.attach(loop)
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="push-server", daemon=True).start()
+        started.wait()
+
+        if errors:
+            raise errors[0]
+
+        return loop
@@ -0,0 +1,108 @@
+"""
+replication.py
+
+Read-only copies (replicas) of the Fakebook database, so that queries which only read data do not compete with writes
+on the primary database file. Each replica is brought up to date by copying the primary into it with SQLite's online
+backup API, every Config.REPLICA_SYNC_INTERVAL seconds.
+
+Every write to the primary is given a version number, and each sync records the version that the replicas are up to
+date with. A session that has written to the database is sent to the primary until the replicas have caught up with
+its last write, so users always see their own changes.
+"""
+import itertools
+import threading
+
+from app.db_pool import ConnectionPool
+
+
+class ReplicaSet:
+
+    def __init__(self, connect, replica_paths, pool_size, pool_timeout):
+        """
+        :param connect: a function that opens a connection to the database at the path it is given
+        :param replica_paths: the paths of the replica database files, which are created if they do not exist
+        :param pool_size: the maximum number of open connections to each replica
+        :param pool_timeout: the number of seconds to wait for a connection to a replica
+        """
+        self.__connect = connect
+        self.__replica_paths = list(replica_paths)
+        self.__pools = [ConnectionPool(self.__replica_connector(path), pool_size, pool_timeout) for path in replica_paths]
+        self.__next_pool = itertools.cycle(self.__pools)
+
+        self.__lock = threading.Lock()
+        self.__sync_lock = threading.Lock()
+        self.__write_version = 0
+        self.__synced_version = 0
+
+    def __replica_connector(self, path):
+
+        def connect_replica():
+            connection = self.__connect(path)
+            connection.execute("PRAGMA query_only = 1")  # Replicas are only ever changed by sync()
+            return connection
+
+        return connect_replica
+
+    @property
+    def synced_version(self):
+        """The version of the last write to the primary that every replica includes"""
+        return self.__synced_version
+
+    def record_write(self):
+        """
+        Records that a write has been committed to the primary database
+        :return: the version number of the write
+        """
+        with self.__lock:
+            self.__write_version += 1
+            return self.__write_version
+
+    def checkout(self):
+        """
+        :return: a tuple of (pool, connection) for the next replica in turn. The connection must be returned with
+        pool.checkin() when it is no longer needed.
+        """
+        with self.__lock:
+            pool = next(self.__next_pool)
+        return pool, pool.checkout()
+
+    def sync(self, primary_path):
+        """Copies the current contents of the primary database into every replica"""
+
+        with self.__sync_lock:
+
+            # Any write recorded after this point may not be included in the copy, so only this version is synced
+            with self.__lock:
+                version = self.__write_version
+
+            primary = self.__connect(primary_path)
+
+            try:
+                for path in self.__replica_paths:
+                    replica = self.__connect(path)
+                    try:
+                        # Replicas are in WAL mode, so queries already running on them carry on reading the previous
+                        # copy until they finish
+                        primary.backup(replica)
+                    finally:
+                        replica.close()
+            finally:
+                primary.close()
+
+            self.__synced_version = version
+
+    def start_sync_thread(self, primary_path, interval, logger):
+        """Starts a daemon thread that syncs the replicas every interval seconds"""
+
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                try:
+                    self.sync(primary_path)
+                except Exception:
+                    logger.exception("Failed to sync read replicas")
+
+        threading.Thread(target=run, name="replica-sync", daemon=True).start()
+
+        return stopped
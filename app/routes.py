@@ -1,8 +1,61 @@
-from flask import render_template, flash, redirect, url_for, session, request
-from werkzeug.utils import secure_filename
-from app import app
-from app.fb_objects import User, UserLoginFailedException, UsernameAlreadyInUseException, EmailAlreadyInUseException, Post, Friendship
-import os, datetime, sqlite3
+from flask import render_template, flash, redirect, url_for, session, request, jsonify, abort, send_file, Response
+from app import app, get_db, get_read_db, last_active_buffer, media_store, db_pool, push_hub, query_metrics, cache
+from app.passwords import HashingBusyException
+from app.fb_objects import User, UserIDNotFoundException, UserLoginFailedException, TooManyLoginAttemptsException, UsernameAlreadyInUseException, EmailAlreadyInUseException, Post, PostIDNotFoundException, Friendship, InvalidCursorException, decode_cursor, ChatGroup, ChatGroupIDNotFoundException
+from markupsafe import Markup
+import os, datetime, json, sqlite3
+
+@app.before_request
+def record_activity():
+
+    # Record when signed in users were last active. This is buffered, so does not touch the database on each request.
+
+    if 'activeUserID' in session:
+        last_active_buffer.record(session['activeUserID'], str(datetime.datetime.utcnow()))
+
+
+def get_active_user():
+    """
+    Returns the signed in User. A snapshot of their row is kept in the session, which is signed so cannot be altered,
+    along with the version of the User's cache key when it was taken. The row is only loaded again once the User has
+    changed, which bumps the version, so most requests do not need to query the database to know who is signed in.
+    """
+
+    user_id = session['activeUserID']
+    version = cache.version(User.cache_key(user_id))
+    snapshot = session.get('activeUser')
+
+    if snapshot and snapshot['id'] == user_id and snapshot['version'] == version:
+        return User(user_id, snapshot['row'])
+
+    row = User.load_row(user_id)
+
+    if row is None:
+        raise UserIDNotFoundException
+
+    # The session cookie is signed but not encrypted, so anyone who has it can read the snapshot. The email address is
+    # left out, as no view needs it.
+    snapshot_row = dict(row, email=None)
+
+    if len(json.dumps(snapshot_row)) <= app.config['ACTIVE_USER_SNAPSHOT_MAX_BYTES']:
+        session['activeUser'] = {'id': user_id, 'version': version, 'row': snapshot_row}
+    else:
+        session.pop('activeUser', None)
+
+    return User(user_id, row)
+
+
+@app.template_global()
+def render_post(post, liked):
+    """
+    Renders a Post in a feed, reusing the HTML rendered before if the Post's like count, whether the viewer likes it
+    and its author's details are all unchanged
+    """
+
+    key = cache.versioned("fragment:post:{:d}:{:d}:{:d}".format(post.id, post.likes_count, liked), User.cache_key(post.author_id))
+
+    return Markup(cache.get_or_set(key, lambda: render_template("_post.html", post=post, liked=liked)))
+
 
 @app.route("/")
 def index():
@@ -15,9 +68,166 @@ def home():
 
         return redirect(url_for('login'))
 
-    active_user = User(session['activeUserID'])
+    active_user = get_active_user()
+
+    # The feed is paginated; 'after' is the token for the last post on the previous page
+    try:
+        posts = active_user.get_feed(after=decode_cursor(request.args.get('after')))
+
+    except InvalidCursorException:
+        return redirect(url_for('home'))
+
+    liked_post_ids = Post.get_liked_post_ids(active_user, [post.id for post in posts])
+
+    return render_template("home.html", user=active_user, posts=posts, liked_post_ids=liked_post_ids, title="{0} {1}'s Feed".format(active_user.first_name, active_user.surname))
+
+
+@app.route('/post/<int:post_id>/like', methods=['POST'])
+def like_post(post_id):
+
+    if 'activeUserID' not in session:
+
+        return redirect(url_for('login'))
+
+    active_user = get_active_user()
+
+    try:
+        post = Post(post_id)
+    except PostIDNotFoundException:
+        abort(404)
+
+    # Users can only like posts that they are allowed to see
+    if post.public or post.author_id == active_user.id or post.author_id in active_user.get_friend_graph().friends:
+
+        if request.form.get('unlike'):
+            post.unlike(active_user)
+        else:
+            post.like(active_user)
+
+    return redirect(request.referrer or url_for('home'))
+
+
+@app.route('/search')
+def search():
+
+    if 'activeUserID' not in session:
+
+        return redirect(url_for('login'))
+
+    active_user = get_active_user()
+    search_text = request.args.get('q', '')
+
+    users = User.search(search_text)
+    posts = Post.search(search_text, active_user)
+
+    return render_template("search.html", user=active_user, search_text=search_text, users=users, posts=posts, title="Search")
+
 
-    return render_template("home.html", user=active_user, title="{0} {1}'s Feed".format(active_user.first_name, active_user.surname))
+@app.route('/chat/<int:chatgroup_id>/messages', methods=['GET', 'POST'])
+def chat_messages(chatgroup_id):
+
+    # GET returns the messages after the id given in 'after' as JSON, so clients polling for new messages only fetch
+    # the ones they do not already have. POST sends one or more messages, each in a 'text' field.
+
+    if 'activeUserID' not in session:
+        abort(401)
+
+    active_user = get_active_user()
+
+    try:
+        chatgroup = ChatGroup(chatgroup_id)
+    except ChatGroupIDNotFoundException:
+        abort(404)
+
+    if not chatgroup.is_member(active_user):
+        abort(403)
+
+    if request.method == "POST":
+        messages = chatgroup.post_messages(active_user, request.form.getlist('text'))
+
+    else:
+        messages = chatgroup.get_messages(after_id=request.args.get('after', 0, type=int))
+
+        if messages:
+            chatgroup.mark_read(active_user, messages[-1].id)
+
+    return jsonify(messages=[message.get_dictionary() for message in messages],
+                   unread_count=chatgroup.get_unread_count(active_user))
+
+
+def parse_batch_ids(ids):
+    """
+    :param ids: a comma separated list of ids from an /api URL
+    :return: the distinct ids as ints, aborting with 400 if any are not ints or there are too many of them
+    """
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids.split(',')))
+    except ValueError:
+        abort(400)
+
+    if len(ids) > app.config['API_MAX_BATCH_SIZE']:
+        abort(400)
+
+    return ids
+
+
+@app.route('/api/users/<ids>')
+def api_users(ids):
+    # The public details of each of the Users whose ids are given, e.g. /api/users/1,2,3, in the order given. Ids of
+    # Users that do not exist are left out.
+
+    if 'activeUserID' not in session:
+        abort(401)
+
+    return jsonify(users=User.get_dictionaries(parse_batch_ids(ids)))
+
+
+@app.route('/api/posts/<ids>')
+def api_posts(ids):
+    # The Posts whose ids are given, in the order given, leaving out any that do not exist or that the signed in User
+    # is not allowed to see
+
+    if 'activeUserID' not in session:
+        abort(401)
+
+    return jsonify(posts=Post.get_dictionaries(parse_batch_ids(ids), Post.visible_to_viewer_sql,
+                                               {'viewer_id': session['activeUserID']}))
+
+
+@app.route('/media/<int:media_id>')
+@app.route('/media/<int:media_id>/<variant>')
+def media(media_id, variant=None):
+
+    if variant is not None and variant not in app.config['MEDIA_VARIANTS']:
+        abort(404)
+
+    media_file = media_store.resolve(get_read_db(), media_id, variant)
+
+    if media_file is None or not os.path.exists(media_file.path):
+        abort(404)
+
+    # send_file answers If-None-Match and Range requests itself, and hands the open file to the server (or to the web
+    # server in front of it with USE_X_SENDFILE) rather than reading it through Python
+    response = send_file(media_file.path, etag=media_file.etag or True,
+                         max_age=app.config['MEDIA_MAX_AGE'] if media_file.immutable else 60)
+
+    if media_file.immutable:
+        response.cache_control.immutable = True
+
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(404)
+
+    gauges = [("fakebook_db_pool_" + name, "Primary database connection pool: " + name.replace('_', ' ') + ".", value)
+              for name, value in db_pool.metrics().items()]
+    gauges.append(("fakebook_push_connections", "Open server-sent event connections.", push_hub.connection_count()))
+
+    return Response(query_metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -27,12 +237,22 @@ def login():
         try:
             user = User.login_user(request.form['email'], request.form['password'])
             session['activeUserID'] = user.id
+            session.pop('activeUser', None)
+            get_active_user()  # Takes the first snapshot, from the row that was just loaded
             return redirect(url_for('home'))
 
         except UserLoginFailedException:
             flash("Email and Password combination incorrect.")
             return redirect(url_for('login'))
 
+        except TooManyLoginAttemptsException:
+            flash("Too many attempts to log in with this email address. Please wait a few minutes and try again.")
+            return redirect(url_for('login'))
+
+        except HashingBusyException:
+            flash("Fakebook is very busy at the moment. Please try again.")
+            return redirect(url_for('login'))
+
     else:
         return render_template('login.html', no_nav_bar=True)
 
@@ -40,8 +260,9 @@ def login():
 @app.route('/logout')
 def logout():
     if 'activeUserID' in session:
-        active_user = User(session['activeUserID']).update_last_active()
+        get_active_user().update_last_active()
         del session['activeUserID']
+        session.pop('activeUser', None)
 
     return redirect(url_for('index'))
 
@@ -64,23 +285,22 @@ def register():
             return render_template('register.html', formdata=request.form)
 
 
-        # Check if profile picture has been included and, if so, save it to the media uploads folder
+        # Check if profile picture has been included and, if so, save it to the media uploads folder. A picture that
+        # has been uploaded before is not stored again.
         profile_pic_file = request.files['profile_pic']
 
         if profile_pic_file and '.' in profile_pic_file.filename and profile_pic_file.filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']:
 
-            filename = str(datetime.datetime.utcnow()).replace(":", "_") + "_" + profile_pic_file.filename
-            filename = secure_filename(filename)
-            profile_pic_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            profile_pic_id = media_store.save_upload(get_db(), profile_pic_file, profile_pic_file.filename.rsplit('.', 1)[1])
 
         else:
             flash("No profile picture provided of an accepted type (png, jpg, gif)")
             return render_template('register.html', formdata=request.form)
 
-        # Now register the new user, passing the path to the profile picture for the new user
+        # Now register the new user, passing the Media id of the profile picture for the new user
         try:
 
-            registered_user = User.register_user(request.form['username'], request.form['email'], request.form['password'], request.form['first_name'], request.form['surname'], filename, request.form['bio'], request.form['dob'])
+            registered_user = User.register_user(request.form['username'], request.form['email'], request.form['password'], request.form['first_name'], request.form['surname'], profile_pic_id, request.form['bio'], request.form['dob'])
             flash("User {} registered!".format(registered_user.username))
 
             return redirect(url_for('login'))
@@ -90,12 +310,17 @@ def register():
 
         except EmailAlreadyInUseException:
             flash("An account has already been registered with this email address")
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            media_store.discard_upload(get_db(), profile_pic_id)
             return render_template('register.html', formdata=request.form)
 
         except UsernameAlreadyInUseException:
             flash("An account has already been registered with this username")
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            media_store.discard_upload(get_db(), profile_pic_id)
+            return render_template('register.html', formdata=request.form)
+
+        except HashingBusyException:
+            flash("Fakebook is very busy at the moment. Please try again.")
+            media_store.discard_upload(get_db(), profile_pic_id)
             return render_template('register.html', formdata=request.form)
 
 
@@ -0,0 +1,70 @@
+"""
+suggestions.py
+
+"People you may know": the FriendSuggestion table holds, for every pair of Users with at least one friend in common,
+the number of mutual friends they have. It is kept up to date as Friendships are accepted and revoked, so finding the
+best suggestions for a User is a single indexed query. recompute_all rebuilds the whole table from the Friendship
+table and can be run with:
+
+    flask recompute-suggestions
+"""
+import click
+from flask.cli import with_appcontext
+
+
+# Every accepted Friendship in both directions, as (user_id, friend_id)
+FRIEND_EDGES_SQL = "SELECT initiator_id AS user_id, recipient_id AS friend_id FROM Friendship WHERE accepted = 1 " \
+                   "UNION ALL SELECT recipient_id, initiator_id FROM Friendship WHERE accepted = 1"
+
+
+def recompute_all(db):
+    """
+    Rebuilds the FriendSuggestion table from scratch for the whole Friendship graph
+    :return: the number of pairs of Users with mutual friends
+    """
+
+    with db:
+        db.execute("DELETE FROM FriendSuggestion")
+        db.execute("WITH Edge AS (" + FRIEND_EDGES_SQL + ") "
+                   "INSERT INTO FriendSuggestion (user_id, candidate_id, mutual_count) "
+                   "SELECT a.user_id, b.user_id, COUNT(*) FROM Edge a JOIN Edge b "
+                   "ON a.friend_id = b.friend_id AND a.user_id != b.user_id "
+                   "GROUP BY a.user_id, b.user_id")
+
+    return db.execute("SELECT COUNT(*) FROM FriendSuggestion").fetchone()[0]
+
+
+def update_mutual_counts(db, a_id, b_id, a_friend_ids, b_friend_ids, change):
+    """
+    Updates the mutual friend counts when a Friendship between Users a and b is accepted (change=1) or revoked
+    (change=-1). a becomes (or stops being) a mutual friend of b and each of a's other friends, and likewise for b.
+    Does not commit, so that the counts change in the same transaction as the Friendship.
+
+    :param a_friend_ids: the ids of a's friends
+    :param b_friend_ids: the ids of b's friends
+    """
+
+    pairs = []
+
+    for friend_id in a_friend_ids:
+        if friend_id != b_id:
+            pairs += [(friend_id, b_id), (b_id, friend_id)]
+
+    for friend_id in b_friend_ids:
+        if friend_id != a_id:
+            pairs += [(friend_id, a_id), (a_id, friend_id)]
+
+    db.executemany("INSERT INTO FriendSuggestion (user_id, candidate_id, mutual_count) VALUES (?, ?, ?) "
+                   "ON CONFLICT (user_id, candidate_id) DO UPDATE SET mutual_count = mutual_count + excluded.mutual_count",
+                   [(user_id, candidate_id, change) for user_id, candidate_id in pairs])
+
+    if change < 0:
+        db.executemany("DELETE FROM FriendSuggestion WHERE user_id = ? AND candidate_id = ? AND mutual_count <= 0", pairs)
+
+
+@click.command('recompute-suggestions')
+@with_appcontext
+def recompute_suggestions_command():
+    """Rebuild the mutual friend counts used for friend suggestions."""
+    from app import get_db
+    click.echo("Stored mutual friend counts for {} pairs of users".format(recompute_all(get_db())))
@@ -79,4 +79,21 @@ def get_waiting_invitations_test(user_id):
 
     waiting_friendships = User(user_id).get_waiting_friendship_invitations()
 
-    return str(len(waiting_friendships))
\ No newline at end of file
+    return str(len(waiting_friendships))
+@app.route('/user_posts_pages_test/<user_id>/<viewer_id>/<page_size>')
+def user_posts_pages_test(user_id, viewer_id, page_size):
+
+    # Reading a User's posts a page at a time must give the same posts as reading them all at once, including any
+    # without a timestamp
+
+    user, viewer = User(user_id), User(viewer_id)
+    all_ids = [post.id for post in Post.get_user_posts(user, viewer)]
+
+    page = Post.get_user_posts(user, viewer, limit=int(page_size))
+    paged_ids = [post.id for post in page]
+
+    while page.next_cursor is not None:
+        page = Post.get_user_posts(user, viewer, limit=int(page_size), after=page.next_cursor)
+        paged_ids += [post.id for post in page]
+
+    return str(paged_ids == all_ids)
@@ -0,0 +1,193 @@
+"""
+timeline.py
+
+Precomputed home feeds ("fan-out on write"). The Timeline table holds, for each User, the most recent Posts by them and
+their friends, so that a page of their feed is a single range read of its primary key rather than a merge of the Posts
+of every one of their friends.
+
+When a Post is written, a background worker adds it to the Timelines of its author and each of their friends, and trims
+each Timeline to the newest Config.TIMELINE_MAX_LENGTH Posts. Pages older than that are read from the Post table as
+before. A User with more than Config.TIMELINE_FANOUT_LIMIT friends would cost too many writes per Post, so they are
+recorded in TimelinePullAuthor instead, and their Posts are merged into their friends' feeds as they are read ("fan-out
+on read"). Accepting a Friendship adds each User's recent Posts to the other's Timeline, and revoking it removes them.
+
+Every Timeline can be rebuilt from the Post and Friendship tables, e.g. after changing the settings, with:
+
+    flask rebuild-timelines
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask.cli import with_appcontext
+
+from app.suggestions import FRIEND_EDGES_SQL
+
+
+# The ids of the friends of the User with id :user_id
+FRIEND_IDS_SQL = "SELECT recipient_id AS friend_id FROM Friendship WHERE accepted = 1 AND initiator_id = :user_id " \
+                 "UNION ALL SELECT initiator_id FROM Friendship WHERE accepted = 1 AND recipient_id = :user_id"
+
+# The cache key of the list of ids of every pull author
+PULL_AUTHORS_CACHE_KEY = "timeline:pull_authors"
+
+
+def rebuild_statements(max_length, fanout_limit):
+    """:return: the SQL statements that rebuild every Timeline and the pull authors from the Post and Friendship tables"""
+
+    return [
+        "DELETE FROM Timeline",
+        "DELETE FROM TimelinePullAuthor",
+        "INSERT INTO TimelinePullAuthor (user_id) SELECT user_id FROM ({edges}) GROUP BY user_id HAVING COUNT(*) > {limit:d}"
+        .format(edges=FRIEND_EDGES_SQL, limit=fanout_limit),
+        # For each User, the newest max_length of their own Posts and those of their friends who are not pull authors.
+        # Posts without a timestamp cannot be ordered in a Timeline, so they are only read from the Post table.
+        "INSERT INTO Timeline (user_id, timestamp, post_id, author_id) "
+        "SELECT Reader.id, Post.timestamp, Post.id, Post.author_id FROM User AS Reader JOIN Post ON Post.id IN ("
+        "SELECT id FROM Post WHERE author_id IN (SELECT Reader.id UNION ALL SELECT friend_id FROM ({friend_ids}) "
+        "WHERE friend_id NOT IN (SELECT user_id FROM TimelinePullAuthor)) AND timestamp IS NOT NULL "
+        "ORDER BY timestamp DESC, id DESC LIMIT {max_length:d})"
+        .format(friend_ids=FRIEND_IDS_SQL.replace(":user_id", "Reader.id"), max_length=max_length),
+    ]
+
+
+class TimelineFanout:
+
+    def __init__(self, db_pool, max_length, fanout_limit, cache, logger, on_write=None):
+        """
+        :param db_pool: the ConnectionPool for the primary database, used by the worker
+        :param max_length: the number of Posts kept in each Timeline
+        :param fanout_limit: the number of friends above which a User's Posts are read rather than written to Timelines
+        :param cache: the Cache that the ids of the pull authors are kept in
+        :param on_write: an optional function called after the worker commits changes
+        """
+        self.__db_pool = db_pool
+        self.__max_length = max_length
+        self.__fanout_limit = fanout_limit
+        self.__cache = cache
+        self.__logger = logger
+        self.__on_write = on_write
+
+        # A single worker, so that changes are made in the order they were queued, e.g. a Post is added to a Timeline
+        # before the Friendship it was added for is revoked
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix="timeline-worker")
+
+    def __later(self, function, *args):
+        future = self.__executor.submit(self.__run, function, *args)
+        future.add_done_callback(self.__log_failure)
+
+    def __run(self, function, *args):
+
+        db = self.__db_pool.checkout()
+
+        try:
+            function(db, *args)
+        finally:
+            self.__db_pool.checkin(db)
+
+        if self.__on_write:
+            self.__on_write()
+
+    def __log_failure(self, future):
+        if future.exception() is not None:
+            self.__logger.error("Failed to update timelines", exc_info=future.exception())
+
+    def add_post_later(self, post_id):
+        """Queues a newly written Post to be added to the Timelines of its readers by the worker"""
+        self.__later(self.add_post, post_id)
+
+    def friendship_accepted_later(self, a_id, b_id):
+        self.__later(self.friendship_accepted, a_id, b_id)
+
+    def friendship_revoked_later(self, a_id, b_id):
+        self.__later(self.friendship_revoked, a_id, b_id)
+
+    def pull_author_ids(self, db):
+        """:return: the set of ids of the Users whose Posts are merged into their friends' feeds as they are read"""
+        return set(self.__cache.get_or_set(PULL_AUTHORS_CACHE_KEY, lambda: [
+            row['user_id'] for row in db.execute("SELECT user_id FROM TimelinePullAuthor")]))
+
+    def add_post(self, db, post_id):
+        """
+        Adds a Post to the Timeline of its author and, unless the author is a pull author, of each of their friends
+        :return: the number of Timelines the Post was added to
+        """
+
+        post = db.execute("SELECT id, author_id, timestamp FROM Post WHERE id=?", [post_id]).fetchone()
+
+        if post is None or post['timestamp'] is None:
+            return 0  # Deleted in the meantime, or cannot be ordered in a Timeline
+
+        reader_ids = [post['author_id']]
+        friend_ids = [row[0] for row in db.execute(FRIEND_IDS_SQL, {'user_id': post['author_id']})]
+        new_pull_author = False
+
+        with db:
+
+            # Authors stay pull authors once they have been made one, until rebuild_all reassesses every User
+            if len(friend_ids) > self.__fanout_limit:
+                new_pull_author = db.execute("INSERT OR IGNORE INTO TimelinePullAuthor (user_id) VALUES (?)",
+                                             [post['author_id']]).rowcount == 1
+
+            elif not self.is_pull_author(db, post['author_id']):
+                reader_ids += friend_ids
+
+            db.executemany("INSERT OR IGNORE INTO Timeline (user_id, timestamp, post_id, author_id) VALUES (?, ?, ?, ?)",
+                           [(reader_id, post['timestamp'], post['id'], post['author_id']) for reader_id in reader_ids])
+
+            self.__trim(db, reader_ids)
+
+        if new_pull_author:
+            self.__cache.delete(PULL_AUTHORS_CACHE_KEY)
+
+        return len(reader_ids)
+
+    def friendship_accepted(self, db, a_id, b_id):
+        """Adds the most recent Posts of each of the Users a and b to the other's Timeline"""
+
+        with db:
+            for reader_id, author_id in [(a_id, b_id), (b_id, a_id)]:
+                if not self.is_pull_author(db, author_id):
+                    db.execute("INSERT OR IGNORE INTO Timeline (user_id, timestamp, post_id, author_id) "
+                               "SELECT :reader_id, timestamp, id, author_id FROM Post "
+                               "WHERE author_id = :author_id AND timestamp IS NOT NULL ORDER BY timestamp DESC, id DESC LIMIT :limit",
+                               {'reader_id': reader_id, 'author_id': author_id, 'limit': self.__max_length})
+
+            self.__trim(db, [a_id, b_id])
+
+    def friendship_revoked(self, db, a_id, b_id):
+        """Removes the Posts of each of the Users a and b from the other's Timeline"""
+
+        with db:
+            db.executemany("DELETE FROM Timeline WHERE user_id = ? AND author_id = ?", [(a_id, b_id), (b_id, a_id)])
+
+    def is_pull_author(self, db, user_id):
+        return db.execute("SELECT 1 FROM TimelinePullAuthor WHERE user_id=?", [user_id]).fetchone() is not None
+
+    def __trim(self, db, user_ids):
+        # Deletes everything older than the max_length'th newest Post of each Timeline
+        db.executemany("DELETE FROM Timeline WHERE user_id = :user_id AND (timestamp, post_id) < ("
+                       "SELECT timestamp, post_id FROM Timeline WHERE user_id = :user_id "
+                       "ORDER BY timestamp DESC, post_id DESC LIMIT 1 OFFSET :offset)",
+                       [{'user_id': user_id, 'offset': self.__max_length - 1} for user_id in user_ids])
+
+    def rebuild_all(self, db):
+        """
+        Rebuilds every Timeline from scratch, reassessing which Users are pull authors
+        :return: the number of Timeline rows
+        """
+
+        with db:
+            for statement in rebuild_statements(self.__max_length, self.__fanout_limit):
+                db.execute(statement)
+
+        self.__cache.delete(PULL_AUTHORS_CACHE_KEY)
+
+        return db.execute("SELECT COUNT(*) FROM Timeline").fetchone()[0]
+
+
+@click.command('rebuild-timelines')
+@with_appcontext
+def rebuild_timelines_command():
+    """Rebuild every User's precomputed home feed."""
+    from app import get_db, timelines
+    click.echo("Stored {} timeline entries".format(timelines.rebuild_all(get_db())))
@@ -0,0 +1,102 @@
+"""
+write_behind.py
+
+Buffers User last_active timestamps in memory and writes them to the database in batches, so that recording a User's
+activity on every request does not cost a committed transaction each time. Timestamps are written at least every
+Config.LAST_ACTIVE_FLUSH_INTERVAL seconds by a background thread, which is woken sooner once
+Config.LAST_ACTIVE_MAX_PENDING users are waiting to be written, and whatever is left is written when the app shuts down.
+Requests never write the timestamps themselves.
+"""
+import threading
+
+
+class LastActiveBuffer:
+
+    def __init__(self, db_pool, max_pending, on_flush=None):
+        """
+        :param db_pool: the ConnectionPool for the primary database
+        :param max_pending: the number of Users with unwritten timestamps at which the flush thread is woken
+        :param on_flush: an optional function called after each batch is committed
+        """
+        self.__db_pool = db_pool
+        self.__max_pending = max_pending
+        self.__on_flush = on_flush
+        self.__pending = {}  # user id: latest last_active timestamp not yet written
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__wake = threading.Event()
+
+    def record(self, user_id, timestamp):
+        """Records that the User with user_id was active at timestamp (a string, as stored in the User table)"""
+
+        with self.__lock:
+            user_id = int(user_id)
+            if user_id not in self.__pending or timestamp > self.__pending[user_id]:
+                self.__pending[user_id] = timestamp
+            full = len(self.__pending) >= self.__max_pending
+
+        if full:
+            self.__wake.set()  # The flush thread writes them, so that this request does not wait for the batch
+
+    def pending(self, user_id):
+        """
+        :return: the last_active timestamp recorded for user_id that has not yet been written, or None
+        """
+        with self.__lock:
+            return self.__pending.get(int(user_id))
+
+    def flush(self):
+        """Writes every pending timestamp to the database in a single transaction"""
+
+        with self.__flush_lock:
+
+            with self.__lock:
+                batch, self.__pending = self.__pending, {}
+
+            if not batch:
+                return
+
+            db = self.__db_pool.checkout()
+
+            try:
+                with db:
+                    db.executemany("UPDATE User SET last_active=? WHERE id=?", [(timestamp, user_id) for user_id, timestamp in batch.items()])
+
+            except Exception:
+
+                # Put the batch back, unless a later timestamp has been recorded since, so it is written next time
+
+                with self.__lock:
+                    for user_id, timestamp in batch.items():
+                        if user_id not in self.__pending or timestamp > self.__pending[user_id]:
+                            self.__pending[user_id] = timestamp
+                raise
+
+            finally:
+                self.__db_pool.checkin(db)
+
+        if self.__on_flush:
+            self.__on_flush()
+
+    def start_flush_thread(self, interval, logger):
+        """
+        Starts a daemon thread that flushes the buffer every interval seconds, or as soon as max_pending Users are waiting
+        :return: an Event that stops the thread, at the end of its current wait, when set
+        """
+
+        stopped = threading.Event()
+
+        def run():
+            while True:
+                self.__wake.wait(interval)
+                self.__wake.clear()
+                if stopped.is_set():
+                    return
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Failed to write buffered last_active timestamps")
+
+        threading.Thread(target=run, name="last-active-flush", daemon=True).start()
+
+        return stopped
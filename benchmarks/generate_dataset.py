@@ -0,0 +1,220 @@
+"""
+generate_dataset.py
+
+Generates a large synthetic Fakebook database to benchmark against, e.g.
+
+    python -m benchmarks.generate_dataset --users 100000 benchmarks/fakebook_bench.db
+
+The schema is created by the app's own migrations. Activity follows a power law, as on real social networks: most
+Users have a few friends and posts, and a few Users have a great many. Every User's password is 'password'.
+"""
+import argparse, itertools, os, random, sys, time
+from datetime import datetime, timedelta
+
+# Allow running as a script from the benchmarks folder as well as with python -m from the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = "password"
+EMAIL = "user{}@example.com"
+
+WORDS = ("the a of to and in is it you that he was for on are with as his they be at one have this from or had by hot "
+         "word but what some we can out other were all there when up use your how said an each she which do their time "
+         "if will way about many then them write would like so these her long make thing see him two has look more day "
+         "could go come did number sound no most people my over know water than call first who may down side been now "
+         "find head stand own page should country found answer school grow study still learn plant cover food sun four "
+         "between state keep eye never last let thought city tree cross farm hard start might story saw far sea draw "
+         "left late run don't while press close night real life few north open seem together next white children begin "
+         "got walk example ease paper group always music those both mark often letter until mile river car feet care "
+         "second book carry took science eat room friend began idea fish mountain stop once base hear horse cut sure "
+         "watch colour face wood main enough plain girl usual young ready above ever red list though feel talk bird "
+         "soon body dog family direct pose leave song measure door product black short numeral class wind question "
+         "happen complete ship area half rock order fire south problem piece told knew pass since top whole king space "
+         "heard best hour better true during hundred five remember step early hold west ground interest reach fast "
+         "verb sing listen six table travel less morning ten simple several vowel toward war lay against pattern slow "
+         "center love person money serve appear road map rain rule govern pull cold notice voice unit power town fine "
+         "certain fly fall lead cry dark machine note wait plan figure star box noun field rest correct able pound "
+         "done beauty drive stood contain front teach week final gave green oh quick develop ocean warm free minute "
+         "strong special mind behind clear tail produce fact street inch multiply nothing course stay wheel full force "
+         "blue object decide surface deep moon island foot system busy test record boat common gold possible plane "
+         "stead dry wonder laugh thousand ago ran check game shape equate miss brought heat snow tire bring yes distant "
+         "fill east paint language among").split()
+
+FIRST_NAMES = ["Ada", "Alan", "Grace", "Linus", "Barbara", "Ken", "Margaret", "Dennis", "Frances", "Edsger", "Radia",
+               "Donald", "Sophie", "Tim", "Annie", "Guido", "Hedy", "John", "Karen", "Niklaus"]
+SURNAMES = ["Lovelace", "Turing", "Hopper", "Torvalds", "Liskov", "Thompson", "Hamilton", "Ritchie", "Allen",
+            "Dijkstra", "Perlman", "Knuth", "Wilson", "Berners-Lee", "Easley", "van Rossum", "Lamarr", "McCarthy",
+            "Jones", "Wirth"]
+
+# The number of rows inserted per executemany
+BATCH_SIZE = 10000
+
+
+def power_law_weights(count, exponent, rng):
+    """
+    :return: cumulative weights for choosing from count items, where the item of rank r is chosen in proportion to
+    1 / r^exponent. Ranks are shuffled, so the most active Users are spread through the id range.
+    """
+    ranks = list(range(1, count + 1))
+    rng.shuffle(ranks)
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in ranks))
+
+
+def random_timestamp(rng, start, days):
+    return str(start + timedelta(seconds=rng.randrange(days * 24 * 60 * 60), microseconds=rng.randrange(1000000)))
+
+
+def insert_batches(db, sql, rows):
+    """Inserts rows (any iterable) in batches of BATCH_SIZE, all in one transaction"""
+
+    count = 0
+
+    with db:
+        for batch in iter(lambda: list(itertools.islice(rows, BATCH_SIZE)), []):
+            db.executemany(sql, batch)
+            count += len(batch)
+
+    return count
+
+
+def generate(db, users, avg_friends, avg_posts, avg_likes, tag_fraction, seed, password_hash, log=print):
+    """
+    Fills an empty, migrated database with synthetic data
+    :return: a dictionary of the number of rows inserted into each table
+    """
+
+    rng = random.Random(seed)
+    user_ids = range(1, users + 1)
+    weights = power_law_weights(users, 0.9, rng)
+    start = datetime.utcnow() - timedelta(days=365)
+    counts = {}
+
+    def log_step(table, started):
+        log("{:>10,} {:<12} {:.1f}s".format(counts[table], table, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    counts['User'] = insert_batches(db, "INSERT INTO User (id, username, email, password_hash, first_name, surname, "
+                                        "joined, profile_pic_id, bio, dob, last_active) VALUES (?,?,?,?,?,?,?,NULL,?,?,?)",
+                                    ((user_id, "user{}".format(user_id), EMAIL.format(user_id),
+                                      password_hash, rng.choice(FIRST_NAMES), rng.choice(SURNAMES),
+                                      random_timestamp(rng, start, 30), "Synthetic user {}".format(user_id),
+                                      "19{:02d}-{:02d}-{:02d}".format(rng.randrange(50, 100), rng.randrange(1, 13), rng.randrange(1, 29)),
+                                      random_timestamp(rng, start, 365)) for user_id in user_ids))
+    log_step('User', started)
+
+    # Friendships join two Users chosen by activity, so popular Users gather many friends
+
+    started = time.perf_counter()
+    pairs = set()
+    wanted = users * avg_friends // 2
+
+    while len(pairs) < wanted:
+        count = wanted - len(pairs)
+        for a, b in zip(rng.choices(user_ids, cum_weights=weights, k=count), rng.choices(user_ids, k=count)):
+            if a != b:
+                pairs.add((min(a, b), max(a, b)))
+
+    counts['Friendship'] = insert_batches(db, "INSERT INTO Friendship (initiator_id, recipient_id, accepted, established_date) VALUES (?,?,?,?)",
+                                          ((a, b, int(rng.random() < 0.9), random_timestamp(rng, start, 365))
+                                           if rng.random() < 0.5 else
+                                           (b, a, int(rng.random() < 0.9), random_timestamp(rng, start, 365))
+                                           for a, b in pairs))
+    del pairs
+    log_step('Friendship', started)
+
+    started = time.perf_counter()
+    post_count = users * avg_posts
+    counts['Post'] = insert_batches(db, "INSERT INTO Post (id, author_id, text, media_id, timestamp, public) VALUES (?,?,?,NULL,?,?)",
+                                    ((post_id, author_id, " ".join(rng.choices(WORDS, k=rng.randrange(3, 30))),
+                                      random_timestamp(rng, start, 365), int(rng.random() < 0.3))
+                                     for post_id, author_id in enumerate(rng.choices(user_ids, cum_weights=weights, k=post_count), 1)))
+    log_step('Post', started)
+
+    # Posts by popular Users are liked and tagged more: choose post ids by the same power law over a shuffled order
+
+    post_weights = power_law_weights(post_count, 0.8, rng)
+    post_ids = range(1, post_count + 1)
+
+    started = time.perf_counter()
+    counts['PostLike'] = insert_batches(db, "INSERT OR IGNORE INTO PostLike (post_id, user_id) VALUES (?,?)",
+                                        zip(rng.choices(post_ids, cum_weights=post_weights, k=post_count * avg_likes),
+                                            rng.choices(user_ids, cum_weights=weights, k=post_count * avg_likes)))
+    log_step('PostLike', started)
+
+    started = time.perf_counter()
+    tag_count = int(post_count * tag_fraction)
+    counts['Tag'] = insert_batches(db, "INSERT OR IGNORE INTO Tag (post_id, tagged_user_id) VALUES (?,?)",
+                                   ((post_id, tagged_user_id) for post_id in rng.sample(post_ids, tag_count)
+                                    for tagged_user_id in rng.choices(user_ids, cum_weights=weights, k=rng.randrange(1, 4))))
+    log_step('Tag', started)
+
+    # The stored counts are normally kept up to date by Post.like and Post.tag
+
+    started = time.perf_counter()
+    with db:
+        db.execute("UPDATE Post SET likes_count = (SELECT COUNT(*) FROM PostLike WHERE PostLike.post_id = Post.id), "
+                   "tags_count = (SELECT COUNT(*) FROM Tag WHERE Tag.post_id = Post.id)")
+    log("{:>10} {:<12} {:.1f}s".format("", "counts", time.perf_counter() - started))
+
+    return counts
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Fakebook database for benchmarking.")
+    parser.add_argument("path", help="the database file to create (replaced if it exists)")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--avg-friends", type=int, default=20, help="average Friendships per User")
+    parser.add_argument("--avg-posts", type=int, default=20, help="average Posts per User")
+    parser.add_argument("--avg-likes", type=int, default=3, help="average likes per Post")
+    parser.add_argument("--tag-fraction", type=float, default=0.1, help="the fraction of Posts with tagged Users")
+    parser.add_argument("--suggestions", action="store_true", help="also compute mutual friend counts (slow for large graphs)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.path)
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    # The app creates the schema with its migrations when it is imported
+
+    os.environ['DATABASE_PATH'] = path
+    os.environ['AUTO_MIGRATE'] = "1"
+
+    from app import connect_db, password_hasher, timelines
+    from app import suggestions
+    from app.migrations import MIGRATIONS
+
+    db = connect_db(path)
+    db.execute("PRAGMA synchronous = OFF")  # The database can simply be generated again if anything goes wrong
+
+    # Updating the full-text search indexes row by row as the data is inserted is far slower than building them
+    # afterwards, so drop their triggers for now. The migration that created them puts them back and rebuilds the indexes.
+
+    search_migration = next(statements for version, description, statements in MIGRATIONS if version == 4)
+
+    for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('User', 'Post')").fetchall():
+        db.execute("DROP TRIGGER " + row['name'])
+
+    started = time.perf_counter()
+    generate(db, args.users, args.avg_friends, args.avg_posts, args.avg_likes, args.tag_fraction, args.seed,
+             password_hasher.generate(PASSWORD))
+
+    with db:
+        for statement in search_migration:
+            db.execute(statement)
+    print("{:>10} {:<12} {:.1f}s".format("", "search", time.perf_counter() - started))
+
+    print("{:>10,} {:<12} {:.1f}s".format(timelines.rebuild_all(db), "timelines", time.perf_counter() - started))
+
+    if args.suggestions:
+        print("{:>10,} {:<12}".format(suggestions.recompute_all(db), "suggestions"))
+
+    db.close()
+
+    print("Generated {} in {:.1f}s".format(path, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+run_benchmarks.py
+
+Times Fakebook's core operations against a database made by generate_dataset.py, e.g.
+
+    python -m benchmarks.run_benchmarks benchmarks/fakebook_bench.db --save benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks benchmarks/fakebook_bench.db --compare benchmarks/baseline.json
+
+Each operation is run many times for randomly chosen Users. Each run is in a fresh request context, so nothing is
+reused from the identity map between runs. The median and 99th percentile latency and the average number of queries
+are reported for each operation. With --compare, the results are checked against a saved run, and the exit status is 1
+if any operation has become slower than --tolerance allows or runs more queries than it did.
+"""
+import argparse, json, os, random, sys, time
+
+# Allow running as a script from the benchmarks folder as well as with python -m from the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate_dataset import EMAIL, PASSWORD
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def time_operation(app, operation, user_ids, iterations, rng, in_request_context=True):
+    """
+    Runs operation(user_id, other_user_id) iterations times for random pairs of Users
+    :param in_request_context: True to run each call in a new request context, and count the queries it runs. If
+    False, operation makes its own requests and returns the number of queries they ran.
+    :return: a dictionary of the p50 and p99 latency in ms and the mean number of queries
+    """
+
+    from app import get_query_profile
+
+    timings = []
+    query_counts = []
+
+    for i in range(iterations):
+
+        user_id, other_id = rng.choice(user_ids), rng.choice(user_ids)
+
+        if in_request_context:
+            with app.test_request_context():
+                started = time.perf_counter()
+                operation(user_id, other_id)
+                timings.append(time.perf_counter() - started)
+                query_counts.append(get_query_profile().total.count)
+
+        else:
+            started = time.perf_counter()
+            query_counts.append(operation(user_id, other_id))
+            timings.append(time.perf_counter() - started)
+
+    timings.sort()
+
+    return {'p50_ms': percentile(timings, 0.5) * 1000, 'p99_ms': percentile(timings, 0.99) * 1000,
+            'queries': sum(query_counts) / len(query_counts)}
+
+
+def run_benchmarks(app, iterations, login_iterations, seed):
+    """:return: a dictionary of operation name: results from time_operation"""
+
+    from app import get_db
+    from app.fb_objects import User, Post, Friendship
+
+    with app.app_context():
+        user_ids = [row['id'] for row in get_db().execute("SELECT id FROM User")]
+
+    rng = random.Random(seed)
+    client = app.test_client()
+
+    def home(user_id, other_id):
+        with client.session_transaction() as session:
+            session['activeUserID'] = user_id
+        response = client.get('/home')
+        assert response.status_code == 200, response.status_code
+        return int(response.headers['X-Query-Count'])
+
+    # (name, operation, iterations, whether to run it in a request context)
+    operations = [
+        ("User(id)", lambda user_id, other_id: User(user_id), iterations, True),
+        ("Post.get_user_posts", lambda user_id, other_id: Post.get_user_posts(User(other_id), User(user_id), limit=20), iterations, True),
+        ("verify_friendship", lambda user_id, other_id: Friendship.verify_friendship(User(user_id), User(other_id)), iterations, True),
+        ("User.get_feed", lambda user_id, other_id: User(user_id).get_feed(), iterations, True),
+        ("login", lambda user_id, other_id: User.login_user(EMAIL.format(user_id), PASSWORD), login_iterations, True),
+        ("/home", home, iterations, False),
+    ]
+
+    results = {}
+
+    for name, operation, count, in_request_context in operations:
+        # Warm up the caches and connection pool first
+        time_operation(app, operation, user_ids, min(count, 10), rng, in_request_context)
+        results[name] = time_operation(app, operation, user_ids, count, rng, in_request_context)
+        print("{:<22} p50 {:>8.2f} ms   p99 {:>8.2f} ms   {:>6.1f} queries".format(
+            name, results[name]['p50_ms'], results[name]['p99_ms'], results[name]['queries']))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param tolerance: the fraction by which an operation's p50 may exceed the baseline's
+    :return: a list of descriptions of each regression
+    """
+
+    regressions = []
+
+    for name, result in results.items():
+
+        if name not in baseline:
+            continue
+
+        if result['p50_ms'] > baseline[name]['p50_ms'] * (1 + tolerance):
+            regressions.append("{}: p50 {:.2f} ms, was {:.2f} ms".format(name, result['p50_ms'], baseline[name]['p50_ms']))
+
+        if result['queries'] > baseline[name]['queries'] + 0.5:
+            regressions.append("{}: {:.1f} queries, was {:.1f}".format(name, result['queries'], baseline[name]['queries']))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark Fakebook's core operations.")
+    parser.add_argument("path", help="a database made by generate_dataset.py")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--login-iterations", type=int, default=50, help="logins are much slower, by design")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON file from --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed increase in p50 when comparing")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.path)
+    os.environ['QUERY_PROFILING'] = "1"
+    os.environ['QUERY_PROFILER_HEADERS'] = "1"
+
+    from app import app
+
+    results = run_benchmarks(app, args.iterations, args.login_iterations, args.seed)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
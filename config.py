@@ -16,4 +16,91 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'MCLy0V22y2pINmsZxcjY1mZ683gSZWVS'
     DATABASE_PATH = os.environ.get("DATABASE_PATH") or os.path.join(basedir, 'fakebook.db')
     UPLOAD_FOLDER = os.environ.get("MEDIA_UPLOADS_PATH") or os.path.join(basedir, 'media_uploads')
-    ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
\ No newline at end of file
+    ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+    # Password hashing. PASSWORD_HASH_METHOD is a werkzeug method including its cost parameters; stored hashes made with
+    # anything else are replaced when the User next logs in. Hashes are computed by PASSWORD_HASH_WORKERS processes, with
+    # at most PASSWORD_HASH_MAX_PENDING waiting or running at once; requests wait up to PASSWORD_HASH_WAIT_TIMEOUT
+    # seconds for a place before being turned away.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD") or "scrypt:32768:8:1"
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 2))
+    PASSWORD_HASH_MAX_PENDING = 64
+    PASSWORD_HASH_WAIT_TIMEOUT = 2
+
+    # The number of login attempts allowed for each email address in LOGIN_ATTEMPT_WINDOW seconds
+    LOGIN_ATTEMPTS_PER_EMAIL = 5
+    LOGIN_ATTEMPT_WINDOW = 300
+
+    # Resized copies made of each uploaded image (if Pillow is installed), as name: maximum width and height in pixels,
+    # and the number of background threads that make them
+    MEDIA_VARIANTS = {'thumbnail': 64, 'small': 200, 'medium': 600}
+    MEDIA_WORKERS = 2
+    # Media files are named by their content, so browsers may cache them for this long (in seconds) without checking
+    MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+    # Set USE_X_SENDFILE=1 when behind a web server that supports X-Sendfile, so it sends media files instead of Flask
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE") == "1"
+
+    # Database connection pool and SQLite tuning
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))  # maximum number of open connections
+    DB_POOL_TIMEOUT = 5  # seconds to wait for a free connection before giving up
+    DB_STATEMENT_CACHE_SIZE = 256  # prepared statements cached per connection
+    DB_JOURNAL_MODE = "WAL"
+    DB_SYNCHRONOUS = "NORMAL"
+    DB_CACHE_SIZE_KB = 16384  # page cache per connection
+    DB_MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file to memory map
+    DB_BUSY_TIMEOUT_MS = 5000  # how long to wait for another connection's write lock
+
+    # Read replicas: a list of database files that read-only queries are spread across, kept up to date with a copy of
+    # DATABASE_PATH every REPLICA_SYNC_INTERVAL seconds. Set READ_REPLICA_PATHS in the environment, separated by the
+    # OS path separator, to enable them.
+    READ_REPLICA_PATHS = [path for path in os.environ.get("READ_REPLICA_PATHS", "").split(os.pathsep) if path]
+    REPLICA_SYNC_INTERVAL = 5
+
+    # User last_active timestamps are buffered in memory and written at least this often (in seconds), or as soon as
+    # this many Users are waiting to be written
+    LAST_ACTIVE_FLUSH_INTERVAL = 10
+    LAST_ACTIVE_MAX_PENDING = 500
+
+    # The number of Users whose friends and pending invitations are kept in the in-memory friend graph cache
+    FRIEND_GRAPH_CACHE_SIZE = 100000
+
+    # Cache for Users' rows, friend suggestions and rendered posts (see app/cache.py). 'memory' keeps a separate cache
+    # in each process; 'sqlite' shares one between every process on the machine, in CACHE_SQLITE_PATH.
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND") or "memory"
+    CACHE_SQLITE_PATH = os.environ.get("CACHE_SQLITE_PATH") or os.path.join(basedir, 'fakebook_cache.db')
+    CACHE_MAX_ENTRIES = 100000  # for the memory backend
+    CACHE_DEFAULT_TTL = 300  # seconds
+
+    # A snapshot of the signed in User's row is kept in their session cookie, unless it is larger than this many bytes
+    # of JSON (browsers limit each cookie to about 4KB)
+    ACTIVE_USER_SNAPSHOT_MAX_BYTES = 2048
+
+    # Precomputed home feeds (see app/timeline.py): the number of Posts kept in each User's Timeline, and the number of
+    # friends above which a User's Posts are merged into their friends' feeds as they are read instead
+    TIMELINE_MAX_LENGTH = 800
+    TIMELINE_FANOUT_LIMIT = 5000
+
+    # The most ids that can be requested at once from /api/users/<ids> and /api/posts/<ids>
+    API_MAX_BATCH_SIZE = 100
+
+    # Server-sent events pushed to browsers by app/push.py. The push server is only started when a port is set.
+    PUSH_SERVER_HOST = os.environ.get("PUSH_SERVER_HOST") or "127.0.0.1"
+    PUSH_SERVER_PORT = int(os.environ.get("PUSH_SERVER_PORT", 0)) or None
+    PUSH_HEARTBEAT_INTERVAL = 15  # seconds
+    PUSH_QUEUE_SIZE = 100  # undelivered events kept per connection
+
+    # Record the queries run by each request (see app/profiler.py), reporting their totals in the response headers if
+    # QUERY_PROFILER_HEADERS is set and appending a table of them to each page if QUERY_PROFILER_TOOLBAR is set, and log
+    # requests that run the same query at least this many times
+    QUERY_PROFILING = os.environ.get("QUERY_PROFILING", "1") == "1"
+    QUERY_PROFILER_HEADERS = os.environ.get("QUERY_PROFILER_HEADERS") == "1"
+    QUERY_PROFILER_TOOLBAR = os.environ.get("QUERY_PROFILER_TOOLBAR") == "1"
+    QUERY_PROFILER_N_PLUS_ONE_THRESHOLD = 5
+    # The addresses allowed to read /metrics
+    METRICS_ALLOWED_ADDRESSES = set(os.environ.get("METRICS_ALLOWED_ADDRESSES", "127.0.0.1,::1").split(","))
+
+    # Apply any outstanding migrations in app/migrations.py to the database when the app starts
+    AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") == "1"
+    # Log a warning at startup for any frequently run query that cannot use an index
+    CHECK_QUERY_PLANS = True
@@ -0,0 +1,283 @@
+"""
+fakebook_data.py
+
+Imports and exports Fakebook's Users, Friendships, Posts, likes and tags, as one newline-delimited JSON or CSV file per
+table in a folder, e.g.
+
+    python fakebook_data.py export dump/
+    python fakebook_data.py import dump/ --database other.db
+    python fakebook_data.py import dump/ --format csv
+
+The files are users, friendships, posts, likes and tags, each with the extension of the format (e.g. users.ndjson), and
+any that are missing are skipped. Each has the columns of its table; likes_count and tags_count are worked out again on
+import. Users may be given a plain text 'password' instead of a 'password_hash', which is hashed on import. Media files
+are not included, so profile_pic_id and media_id are copied as they are. CSV cannot tell an empty string from NULL, so
+an empty field in a CSV file is NULL in the columns that may be NULL (e.g. an empty bio becomes NULL); use NDJSON for an
+exact copy.
+
+Rows are imported in transactions of --chunk-size rows. The indexes and search triggers of the tables being loaded are
+dropped first and built again once every file has been loaded, which is much faster than updating them row by row. The
+number of rows committed from each file is recorded in the same transaction as the rows, so an import that is
+interrupted carries on where it stopped when it is run again with the same files (use --restart to start again).
+Friend suggestions, timelines and search indexes are rebuilt at the end. Restart the app afterwards, as it caches
+Friendships and Users in memory.
+"""
+import argparse, csv, itertools, json, os, time
+
+
+def nullable_str(value):
+    """The type of the text columns that may be NULL"""
+    return str(value)
+
+
+# The kinds of record, in the order they are imported: the file name, table and columns with the type of each
+KINDS = [
+    ('users', 'User', [('id', int), ('username', str), ('email', str), ('password_hash', str), ('first_name', str),
+                       ('surname', str), ('joined', str), ('profile_pic_id', int), ('bio', nullable_str),
+                       ('dob', nullable_str), ('last_active', nullable_str)]),
+    ('friendships', 'Friendship', [('id', int), ('initiator_id', int), ('recipient_id', int), ('accepted', int),
+                                   ('established_date', nullable_str)]),
+    ('posts', 'Post', [('id', int), ('author_id', int), ('text', str), ('media_id', int), ('timestamp', nullable_str),
+                       ('public', int)]),
+    ('likes', 'PostLike', [('post_id', int), ('user_id', int)]),
+    ('tags', 'Tag', [('post_id', int), ('tagged_user_id', int)]),
+]
+
+FORMATS = ['ndjson', 'csv']
+
+# Progress is logged at most this often, in seconds
+PROGRESS_INTERVAL = 1
+
+
+def read_records(f, file_format):
+    """:return: an iterator of a dictionary for each record in the open text file f"""
+    if file_format == 'csv':
+        return csv.DictReader(f)
+    return (json.loads(line) for line in f if line.strip())
+
+
+def convert(record, columns, file_format):
+    """:return: a tuple of the values of columns in record, converted to the type of each column"""
+    values = []
+    for name, column_type in columns:
+        value = record.get(name)
+        if value is None or (value == '' and (column_type is int or column_type is nullable_str and file_format == 'csv')):
+            values.append(None)
+        else:
+            values.append(column_type(value))
+    return tuple(values)
+
+
+class Progress:
+    """Logs the number of rows done so far, and how far through its file the import or export is"""
+
+    def __init__(self, name, size, log):
+        self.__name = name
+        self.__size = size
+        self.__log = log
+        self.__started = self.__logged = time.perf_counter()
+        self.rows = 0
+
+    def add(self, rows, position=None, final=False):
+        self.rows += rows
+        now = time.perf_counter()
+        if final or now - self.__logged >= PROGRESS_INTERVAL:
+            self.__logged = now
+            percent = " {:>4.0%}".format(position / self.__size) if position is not None and self.__size else ""
+            self.__log("{:<12} {:>12,} rows{} {:>10,.0f} rows/s".format(
+                self.__name, self.rows, percent, self.rows / max(now - self.__started, 1e-9)))
+
+
+def export_data(db, folder, file_format, chunk_size, log=print):
+    """
+    Writes every row of each kind to a file in folder
+    :return: a dictionary of the number of rows written for each kind
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    counts = {}
+
+    for name, table, columns in KINDS:
+
+        column_names = [column for column, column_type in columns]
+        path = os.path.join(folder, "{}.{}".format(name, file_format))
+        progress = Progress(name, None, log)
+        rows = db.execute("SELECT {} FROM {} ORDER BY {}".format(", ".join(column_names), table, column_names[0]))
+
+        # Written to a temporary file first, so that an interrupted export does not leave a file that looks complete
+        with open(path + ".part", 'w', newline='', encoding='utf-8') as f:
+
+            writer = csv.writer(f) if file_format == 'csv' else None
+            if writer:
+                writer.writerow(column_names)
+
+            for chunk in iter(lambda: rows.fetchmany(chunk_size), []):
+                if writer:
+                    writer.writerows(chunk)
+                else:
+                    f.writelines(json.dumps(dict(zip(column_names, row)), ensure_ascii=False) + "\n" for row in chunk)
+                progress.add(len(chunk))
+
+        os.replace(path + ".part", path)
+        progress.add(0, final=True)
+        counts[name] = progress.rows
+
+    return counts
+
+
+def defer_indexes(db, tables):
+    """
+    Drops the indexes (other than unique ones, which enforce constraints) and triggers of tables, saving them in
+    ImportDeferred to be created again by restore_indexes. Anything already saved by an interrupted import is kept.
+    """
+
+    with db:
+        for row in db.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND "
+                              "sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%' AND tbl_name IN ({})"
+                              .format(",".join("?" * len(tables))), tables).fetchall():
+            db.execute("INSERT OR IGNORE INTO ImportDeferred (name, sql) VALUES (?, ?)", [row['name'], row['sql']])
+            db.execute("DROP {} {}".format(row['type'].upper(), row['name']))
+
+
+def restore_indexes(db, log=print):
+    """Creates the indexes and triggers saved by defer_indexes again, and rebuilds the search indexes"""
+
+    started = time.perf_counter()
+
+    with db:
+        for row in db.execute("SELECT name, sql FROM ImportDeferred").fetchall():
+            db.execute(row['sql'])
+        db.execute("DELETE FROM ImportDeferred")
+
+        # The triggers that keep these up to date were not there while the rows were loaded
+        db.execute("INSERT INTO UserSearch(UserSearch) VALUES ('rebuild')")
+        db.execute("INSERT INTO PostSearch(PostSearch) VALUES ('rebuild')")
+
+    log("{:<12} {:>30.1f}s".format("indexes", time.perf_counter() - started))
+
+
+def import_data(db, folder, file_format, chunk_size, replace=False, restart=False, log=print):
+    """
+    Loads the files of each kind in folder into db, resuming an interrupted import of the same files unless restart
+    :param replace: True to replace existing rows with the same primary key, rather than stopping with an error
+    :return: a dictionary of the number of rows imported from each file
+    """
+
+    from app import password_hasher, timelines, cache
+    from app import suggestions
+
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS ImportProgress (path TEXT PRIMARY KEY, rows INTEGER NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS ImportDeferred (name TEXT PRIMARY KEY, sql TEXT NOT NULL)")
+        if restart:
+            db.execute("DELETE FROM ImportProgress")
+
+    kinds = [(name, table, columns, os.path.abspath(os.path.join(folder, "{}.{}".format(name, file_format))))
+             for name, table, columns in KINDS]
+    kinds = [kind for kind in kinds if os.path.exists(kind[3])]
+
+    defer_indexes(db, [table for name, table, columns, path in kinds])
+
+    counts = {}
+
+    for name, table, columns, path in kinds:
+
+        column_names = [column for column, column_type in columns]
+        sql = "INSERT {}INTO {} ({}) VALUES ({})".format("OR REPLACE " if replace else "", table,
+                                                       ", ".join(column_names), ",".join("?" * len(columns)))
+
+        row = db.execute("SELECT rows FROM ImportProgress WHERE path=?", [path]).fetchone()
+        done = row['rows'] if row else 0
+
+        with open(path, newline='', encoding='utf-8') as f:
+
+            progress = Progress(name, os.fstat(f.fileno()).st_size, log)
+            records = read_records(f, file_format)
+
+            if done:
+                log("{:<12} skipping {:,} rows imported before".format(name, done))
+                records = itertools.islice(records, done, None)
+
+            for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+
+                if table == 'User':
+                    # Plain text passwords are hashed by every worker process at once
+                    unhashed = [record for record in chunk if not record.get('password_hash')]
+                    for record in unhashed:
+                        if not record.get('password'):
+                            raise ValueError("User {} has neither a password_hash nor a password".format(record.get('id')))
+                    for record, password_hash in zip(unhashed, password_hasher.generate_many([record['password'] for record in unhashed])):
+                        record['password_hash'] = password_hash
+
+                with db:
+                    db.executemany(sql, [convert(record, columns, file_format) for record in chunk])
+                    db.execute("INSERT OR REPLACE INTO ImportProgress (path, rows) VALUES (?, ?)", [path, done + len(chunk)])
+
+                done += len(chunk)
+                progress.add(len(chunk), f.buffer.tell())
+
+            progress.add(0, f.buffer.tell(), final=True)
+            counts[name] = progress.rows
+
+    restore_indexes(db, log)
+
+    # Work out the data that is normally kept up to date as rows are written one at a time
+
+    started = time.perf_counter()
+    with db:
+        db.execute("UPDATE Post SET likes_count = (SELECT COUNT(*) FROM PostLike WHERE PostLike.post_id = Post.id), "
+                   "tags_count = (SELECT COUNT(*) FROM Tag WHERE Tag.post_id = Post.id)")
+    log("{:<12} {:>30.1f}s".format("counts", time.perf_counter() - started))
+
+    started = time.perf_counter()
+    suggestions.recompute_all(db)
+    log("{:<12} {:>30.1f}s".format("suggestions", time.perf_counter() - started))
+
+    started = time.perf_counter()
+    timelines.rebuild_all(db)
+    log("{:<12} {:>30.1f}s".format("timelines", time.perf_counter() - started))
+
+    cache.clear()
+
+    with db:
+        db.execute("DROP TABLE ImportProgress")
+        db.execute("DROP TABLE ImportDeferred")
+
+    return counts
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Import or export Fakebook's users, friendships, posts, likes and tags.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("folder", help="the folder of files to import, or to export to")
+    parser.add_argument("--database", help="the database to use, instead of the app's DATABASE_PATH")
+    parser.add_argument("--format", choices=FORMATS, default=FORMATS[0])
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows per transaction")
+    parser.add_argument("--replace", action="store_true", help="replace existing rows with the same ids when importing")
+    parser.add_argument("--restart", action="store_true", help="import every file from the start, even after an interrupted import")
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+
+    # The app creates or updates the schema with its migrations when it is imported
+    os.environ['AUTO_MIGRATE'] = "1"
+
+    from app import connect_db
+
+    db = connect_db()
+    started = time.perf_counter()
+
+    if args.action == "export":
+        counts = export_data(db, args.folder, args.format, args.chunk_size)
+    else:
+        counts = import_data(db, args.folder, args.format, args.chunk_size, args.replace, args.restart)
+
+    db.close()
+
+    print("{}ed {:,} rows in {:.1f}s".format(args.action.capitalize(), sum(counts.values()), time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()